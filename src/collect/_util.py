@@ -0,0 +1,61 @@
+"""
+Helpers shared by the collect applications
+"""
+from collections import defaultdict
+import queue
+import threading
+from typing import Dict
+
+from cpiapi import all_table_dicts
+
+_table_index = None                     # {table_name: [dict, ...], ...} built by table_index()
+
+
+def prefetch(records, batch_size: int = 1024, depth: int = 4):
+    """Generator that yields each record from ``records``, which a worker thread
+    reads ahead in batches. Overlaps producing the records with processing them.
+    Use only when ``records`` does not output messages, which would then be out of order.
+
+    :param records:     iterable of records
+    :param batch_size:  number of records in each batch
+    :param depth:       maximum number of batches read ahead
+    :return:            generator of the records. Re-raises any exception from ``records``
+    """
+    batches = queue.Queue(maxsize=depth)
+
+    def fill():
+        try:
+            batch = []
+            for rec in records:
+                batch.append(rec)
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    batch = []
+            batches.put(batch)
+        except BaseException as e:      # pass the exception to the consumer
+            batches.put(e)
+        finally:
+            batches.put(None)           # end of records, however records ended
+
+    threading.Thread(name='prefetch', target=fill, daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if isinstance(batch, BaseException):
+            raise batch
+        yield from batch
+
+
+def table_index() -> Dict[str, list]:
+    """Index all_table_dicts by table name. Built once, on the first call.
+
+    :return:            {table_name: [each dict in all_table_dicts that defines table_name], ...}
+    """
+    global _table_index
+    if _table_index is None:
+        _table_index = defaultdict(list)
+        for table_dict in all_table_dicts:
+            for table_name in table_dict:
+                _table_index[table_name].append(table_dict)
+    return _table_index
@@ -8,21 +8,33 @@ cpiapi.production, and write each sample to ./files
 """
 from argparse import ArgumentParser
 from collections import defaultdict
+import functools
 import json
 import os
 import pprint
 import os
+import queue
 import sys
 import threading
 from time import sleep, time
 from typing import Dict, Union
 
-from cpiapi import add_table, all_table_dicts, allTypes, Cpi, date_bad, \
+from cpiapi import add_table, allTypes, Cpi, date_bad, \
     find_table, Pager, production, real_time, SubTable, Table, to_enum
 from mylib import anyToSecs, credentials, strfTime, logErr, printIf, verbose_1
 
+from _util import table_index
+
 TAU = 20 			# time-constant for recordsPerHour learning. Samples or Days
 sampling = [-1, 20, 1]  # initialize down-counter to sample [no, nth, every] record
+# The scheduling report formats the same, slowly changing, times every cycle
+cached_strfTime = functools.lru_cache(maxsize=4096)(strfTime)
+cached_anyToSecs = functools.lru_cache(maxsize=4096)(anyToSecs)
+# {type: function to format a time of that type as text, or '-' when unset, ...}
+time_formats = {str: lambda t: cached_strfTime(t) if t != '0' else '-',
+                float: lambda t: cached_strfTime(t) if t > 0 else '-',
+                int: lambda t: cached_strfTime(t) if t > 0 else '-'}
+state_queue = queue.Queue()             # (file_name, state) for state_writer to write
 """ To do
 Collection of ClientDetails slows after a few thousand records.
 Break up the collection into 5000 record chunks.
@@ -42,6 +54,12 @@ To facilitate progress on all APIs, nextPoll must exponentially advance toward a
     2+ hours ahead of actual EDT local time of the sample
     histPager(record) is called on raw record. It stores final collectionTime text w/o flatten's time correction
 - find and fix all lines with *****
+- cpiapi's Pager parses each page with json.loads before yielding any record.
+    Stream large pages (e.g. ClientDetails) with an incremental parser (e.g. ijson)
+    so that flatten() and the csv writes overlap the remainder of the download.
+- Each collect() thread already re-uses one Cpi instance for all of its polls.
+    Have cpiapi's Cpi keep one pooled keep-alive HTTP session, and its Pager
+    request the next page while the current page is being flattened.
 - When Cisco has fixed UTC zone formatting, remove DateBad correction in flatten() 
 - change dar5 password on ncs01
 - install certificate(s)
@@ -60,6 +78,21 @@ Not to do
 """
 
 
+@functools.lru_cache(maxsize=None)
+def cached_find_table(table_name: str, version: Union[str, None]) -> Union[Table, None]:
+    """find_table(table_name, all_table_dicts, version), memoized by (table_name, version).
+    Searches only the dicts that define table_name.
+
+    :param table_name:  name of the table
+    :param version:     API version, or None to match any version
+    :return:            table definition, or None if not defined
+    """
+    dicts = table_index().get(table_name)
+    if not dicts:                       # table_name is not defined?
+        return None
+    return find_table(table_name, dicts, version)
+
+
 def check_fields(table: SubTable, record: dict):
     """Sample [no | every n'th | every] record based on table.check_[enums|fields].
     For each enum field, count the instances by value.
@@ -71,12 +104,13 @@ def check_fields(table: SubTable, record: dict):
     table.check_enums -= 1
     table.check_fields -= 1
     if table.check_enums == 0:          # Counter underflow?
-        for key, val in record.items():  # Yes -- sample. Count values by ENUM field
-            ftk = table.fieldTypes.get(key, {'values': None})  # field's type definition
-            if isinstance(ftk['values'], dict):  # defined as an ENUM?
-                table.field_values[key][val] += 1  # count by enum value
+        for key in table.enum_fields:   # Yes -- sample. Count values by ENUM field
+            if key in record:
+                table.field_values[key][record[key]] += 1  # count by enum value
         table.check_enums = table.sample_enums
     if table.check_fields == 0:         # Counter  underflow?
+        # Not a pre-filtered tuple of fields, as for the ENUMs: field_report must also see
+        # each unknown or unSELECTed field in the record, in order to report it
         for key, val in record.items():  # Yes -- sample. Count types by field
             table.field_counts[key][type(val)] += 1  # Number of instances of each type
         table.check_fields = table.sample_fields
@@ -91,8 +125,13 @@ def check_fields_init(sub_table: SubTable, fields: int = 0, enums: int = 0):
     """
     sub_table.field_counts = defaultdict(lambda: defaultdict(int))  # count of instances of each field
     sub_table.field_values = defaultdict(lambda: defaultdict(int))  # count of each value for each enum field
+    # (field_name, ...) of the fields defined as an ENUM
+    sub_table.enum_fields = tuple(k for k, v in sub_table.fieldTypes.items()
+                                  if isinstance(v.get('values', None), dict))
     sub_table.check_enums = sub_table.sample_enums = sampling[min(enums, len(sampling))]
     sub_table.check_fields = sub_table.sample_fields = sampling[min(fields, len(sampling))]
+    # check_fields need be called only if fields or enums will be sampled
+    sub_table.needs_check = sub_table.sample_fields > 0 or sub_table.sample_enums > 0
 
 
 def collect(tables: dict, real_time: bool = False, semaphore: threading.Semaphore = None):
@@ -149,9 +188,9 @@ def collect(tables: dict, real_time: bool = False, semaphore: threading.Semaphor
             by_nextPoll.sort(key=lambda x: [x[0], x[2]])
             for nxt_poll, tbl, tbl_name in by_nextPoll:
                 print(f"{my_name}{tbl.lastId:12}, ", end='')
-                print(','.join("{:>20}".format(strfTime(t) if isinstance(t, str) and t != '0' or t > 0 else '-')
+                print(','.join("{:>20}".format(time_formats.get(type(t), lambda x: '-')(t))
                     for t in (tbl.minSec, tbl.maxTime, tbl.nextPoll, tbl.startPoll)), end='')
-                secs = anyToSecs(tbl.maxTime)
+                secs = cached_anyToSecs(tbl.maxTime)
                 hours = int((time() - secs) / 3600) if secs is not None and secs != 0.0 else ''
                 print(f",{int(tbl.recordsPerHour):8},{hours:4}, {tbl.tableName}")
 
@@ -204,13 +243,18 @@ def collect(tables: dict, real_time: bool = False, semaphore: threading.Semaphor
         check_fields_init(tbl, 2 if args.fields == 2 else occasional*args.fields,
                           2 if args.enums == 2 else occasional*args.enums)
 
-        tbl.open_writer(file_name)  	# open table DictWriter; write header record
+        open_writer(tbl, file_name)  	# open table DictWriter; write header record
         for name in tbl.subTables:  	# for each sub_table ...
             sub_table = tbl.subTables[name]
             sub_table.recCnt = 0
+            sub_table.select_set = frozenset(sub_table.select)  # for flatten's membership tests
+            sub_table.key_names = tuple(k for t, k in sub_table.key_defs)  # parent's key names
+            sub_table.needs_check = False  # until check_fields_init
+            # only the key fields, copied from the parent, are Selected for output?
+            sub_table.no_output = len(sub_table.select) == len(sub_table.key_defs)
             if len(sub_table.select) == 0:  # ... any fields defined to be output?
                 continue  				# No. So don't open an output file
-            sub_table.open_writer(tbl.file_name + '_' + name)  # Open its DictWriter
+            open_writer(sub_table, tbl.file_name + '_' + name)  # Open its DictWriter
             check_fields_init(sub_table,
                               2 if args.fields == 2 else occasional*args.fields,
                               2 if args.enums == 2 else occasional*args.enums)
@@ -220,9 +264,10 @@ def collect(tables: dict, real_time: bool = False, semaphore: threading.Semaphor
             semaphore.acquire()			# Yes. Pause the low-priority collector
             sleep(Cpi.windowSize) 		# age-out other Cpi's activity.
         success = True					# Assume successful collection
+        flat = dict()                   # re-used for each flattened record
         try:
             for rec in tbl.generator(server=myCpi, table=tbl, verbose=verbose_1(args.verbose)):
-                flat = dict()
+                flat.clear()
                 # Flatten tree into a single level dict with hierarchical field names.
                 # Recursively output sub_table records, not incl. in flattened results
                 flatten(rec, flat, tbl, '')
@@ -233,13 +278,14 @@ def collect(tables: dict, real_time: bool = False, semaphore: threading.Semaphor
                     else:
                         lastTime = flat[tbl.timeField]  # remember last value
                 try:
-                    tbl.writer.writerow(flat)
+                    write_row(tbl, flat)
                 except (UnicodeError, UnicodeEncodeError): 	# csv's strict decode to ASCII failed
                     for fld in flat: 	# convert str to ascii w/ backslash where necessary
                         if isinstance(flat[fld], str):
                             flat[fld] = flat[fld].encode('utf-8').decode('ascii', 'backslashreplace')
-                    tbl.writer.writerow(flat)
-                check_fields(tbl, flat)
+                    write_row(tbl, flat)
+                if tbl.needs_check:
+                    check_fields(tbl, flat)
         except (ConnectionAbortedError, ConnectionError, ConnectionRefusedError) as e:
             success = False  # collection failed. Will close, but not rename output
             logErr(f"{my_name}{e} reading {tbl.tableName}")
@@ -424,7 +470,7 @@ def flatten(tree: dict, result: dict, table: Table, path: str = ''):
         val = tree[key]
         sub_table = table.subTables.get(new_path, None)
         if sub_table is not None: 		# sub_table
-            if len(sub_table.select) == len(sub_table.key_defs):
+            if sub_table.no_output:
                 continue				# no Selected fields to output
             try:						# navigate to the list
                 lst = val[key[:-1]]
@@ -434,30 +480,33 @@ def flatten(tree: dict, result: dict, table: Table, path: str = ''):
             if not isinstance(lst, list):
                 logErr(f"sub-table {key}[{key[:-1]}] is not a list")
                 raise TypeError
+            if len(lst) == 0:
+                continue				# no sub-table records
+            # primary name:values to copy into each sub-table record
+            key_vals = []
+            for k in sub_table.key_names:
+                try:
+                    key_vals.append((k, result[k]))
+                except KeyError:
+                    logErr(f"Error copying results[{k}] to record[{k}] in record {table.recCnt}")
+                    raise KeyError
+            rec_dict = dict()           # re-used for each flattened sub-table record
             for rec in lst:
-                # copy primary name:values into each sub-table record
-                for t, k in sub_table.key_defs:
-                    try:
-                        rec[k] = result[k]
-                    except KeyError:
-                        logErr(f"Error copying results[{k}] to record[{k}] in record {table.recCnt}")
-                        raise KeyError
-                rec_dict = dict()
+                rec_dict.clear()
+                rec_dict.update(key_vals)  # seed with the primary name:values for nested sub-tables
                 flatten(rec, rec_dict, table, '')  # recurse w/ results to rec_dict
-                check_fields(sub_table, rec_dict)
-                empty = True
-                for k in rec_dict:
-                    if k in sub_table.select:
-                        empty = False 	# at least one field is selected for output
-                        break
-                if not empty:			# any field(s) present to output?
+                rec_dict.update(key_vals)  # primary name:values take precedence over rec's own
+                if sub_table.needs_check:
+                    check_fields(sub_table, rec_dict)
+                # at least one field is selected for output?
+                if not sub_table.select_set.isdisjoint(rec_dict):
                     try:
-                        sub_table.writer.writerow(rec_dict)  # yes, write to output
+                        write_row(sub_table, rec_dict)  # yes, write to output
                     except (UnicodeError, UnicodeEncodeError):  # csv's strict convert to ascii failed
                         for fld in rec_dict:  # convert str to ascii w/ backslash where necessary
                             if isinstance(rec_dict[fld], str):
                                 rec_dict[fld] = rec_dict[fld].encode('utf-8').decode('ascii', 'backslashreplace')
-                        sub_table.writer.writerow(rec_dict)  # yes, write to output
+                        write_row(sub_table, rec_dict)  # yes, write to output
                     sub_table.recCnt += 1
             # Note that subTable does not return anything into parent results
         elif isinstance(val, dict): 	# compound structure
@@ -466,8 +515,59 @@ def flatten(tree: dict, result: dict, table: Table, path: str = ''):
             continue					# primitive was processed during first pass
 
 
+def open_writer(table: SubTable, file_name: str):
+    """Open the [Sub]Table's csv DictWriter, and cache its field order for write_row.
+    The field order is cached only if the DictWriter ignores extra fields,
+    because write_row's positional write would silently drop them.
+
+    :param table:       the [Sub]Table
+    :param file_name:   file name, without extension, of the output file
+    """
+    table.open_writer(file_name)
+    writer = table.writer
+    # output field order, or None to have DictWriter.writerow check for extra fields
+    table.out_fields = tuple(writer.fieldnames) if writer.extrasaction == 'ignore' else None
+    table.out_restval = writer.restval  # value written for a missing field
+
+
+def write_row(table: SubTable, row: dict):
+    """Write the flattened ``row`` to the table's csv file.
+    Equivalent to table.writer.writerow(row). When the DictWriter ignores extra fields,
+    it bypasses DictWriter's per-row field checking by writing the list of field values
+    to its csv.writer. Otherwise DictWriter raises ValueError for an extra field.
+
+    :param table:       the [Sub]Table opened by open_writer
+    :param row:         flattened record
+    """
+    fields = table.out_fields
+    if fields is None:                  # DictWriter raises for extra fields?
+        table.writer.writerow(row)      # Yes. Have it check the row
+    else:
+        restval = table.out_restval
+        table.writer.writer.writerow([row.get(f, restval) for f in fields])
+
+
+def state_writer():
+    """Thread target: write each (file_name, state) from state_queue to a JSON file.
+    Keeps file I/O out of the collection loop. Writes to a temporary file, then
+    atomically replaces file_name, so that a crash can't leave a partial file.
+    """
+    while True:
+        file_name, state = state_queue.get()
+        tmp_name = file_name + '.tmp'
+        try:
+            with open(tmp_name, 'w') as json_file:
+                json.dump(state, json_file, separators=(',', ':'))  # dump compact JSON to temporary file
+            os.replace(tmp_name, file_name)  # then atomically replace the file
+        except Exception as e:          # e.g. OSError, or TypeError from a state value
+            logErr(f"{type(e).__name__} {e} writing {file_name}")
+        finally:
+            state_queue.task_done()     # so that state_queue.join() can't hang
+
+
 def write_state(file_name: str, tables: dict):
-    """Write all tables' dynamic state variables to a JSON file
+    """Queue a snapshot of all tables' dynamic state variables to be written
+    to a JSON file by the state_writer thread.
 
     :param file_name:   file_name to write JSON-encoded state
     :param tables:      {tableName:table, ...}
@@ -478,8 +578,7 @@ def write_state(file_name: str, tables: dict):
         state[key] = {'lastId': t.lastId, 'minSec': t.minSec,
             'maxTime': t.maxTime, 'nextPoll': t.nextPoll,
             'recordsPerHour': t.recordsPerHour, 'startPoll': t.startPoll}
-    with open(file_name, 'w') as json_file:
-        json.dump(state, json_file) 	# dump as JSON to file
+    state_queue.put((file_name, state))
 
 
 def read_state(file_name: str, tables: dict):
@@ -572,7 +671,7 @@ sys.exit()
 len_production = len(production)
 for tn in args.table_name:              # add each table explicitly requested
     if tn not in production:		    # not normally a production table?
-        tbl = find_table(tn, all_table_dicts, args.ver)
+        tbl = cached_find_table(tn, args.ver)
         if tbl is not None:			    # However, have a definition for the table?
             print(f"{tn} definition added for this job")  # Yes
             add_table(production, tbl)  # add table to production for this job
@@ -590,7 +689,7 @@ Pager.catchup = Pager.catchup*(1+len(production))/len_production**2
 
 if args.SQL or args.hive:				# output table definitions?
     for table_name in args.table_name:
-        tbl = find_table(table_name, all_table_dicts, args.ver)
+        tbl = cached_find_table(table_name, args.ver)
         if tbl is None:
             print(f"Unknown table {table_name}")
             continue
@@ -619,6 +718,7 @@ if args.buggyAPI:
 # The real_time and low_priority collect threads each have their own Cpi instance.
 # This allows the real_time to block the low_priority for the duration of each poll.
 semaphore = threading.Semaphore()		# for realtime to be able to block myCpi
+threading.Thread(name='state_writer', target=state_writer, daemon=True).start()
 if args.realtime and len(real_time) > 0:  # start real-time thread too?
     print('Starting realtime collect')
     rt = threading.Thread(name='realtime', target=collect,
@@ -629,3 +729,4 @@ if len(production) > 0:
 
 if args.realtime and len(real_time) > 0:	 # Real-time collection started?
     rt.join()							# Yes. Join before exiting
+state_queue.join()						# complete writing of any queued state
@@ -9,28 +9,95 @@ to facilitate appending only the new polls.
 """
 
 from argparse import ArgumentParser
+import atexit
+from collections import OrderedDict
 import csv
 import os
 import json
+import queue
 import re
+import threading
 import time
 
 import cpiapi
 from mylib import credentials, logErr, strfTime
+try:									# orjson is optional, but faster
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    json_loads = json.loads
 """To Do
 
 """
 
-mac_state = dict() 			# {mac: most recent record, ...}
+mac_state = OrderedDict()	# {mac: most recent updateTime, ...} least recently seen first
+mac_state_max = 200000		# maximum number of macs remembered in mac_state
+mac_state_age = 24*60*60	# forget a mac not updated in this many seconds
+last_state = None			# JSON bytes most recently written by write_state
+pending_state = None		# (file_name, state) posted for state_saver to write
+state_dirty = threading.Event()	# pending_state has not been written yet
+state_lock = threading.Lock()	# serializes the state_saver and exit writes
+_MISSING = object()			# sentinel for an attribute missing from the saved state
+BRIEF_RE = re.compile(r'([0-9]+_)(Client.+)\.csv')  # file name of a ClientBrief csv file
+rollover_q = queue.Queue()	# (closed csv file, destination) for the rollover thread to move
 
 
-def write_state(file_name: str, tables: dict):
-    """Writes all tables' dynamic state variables to a JSON file
+def produce(generator, records: queue.Queue):
+    """Thread target: put each record from generator into records, then None.
+    An exception raised by generator is put before the None, for the consumer to re-raise.
 
     Parameters:
-        file_name (str):	file_name to write JSON-encoded state
-        tables (dict):		{tableName:table, ...}
+        generator:			the table's record generator
+        records (Queue):	queue to the consumer
+    """
+    try:
+        for rec in generator:
+            records.put(rec)
+    except BaseException as e:			# pass the exception to the consumer
+        records.put(e)
+    finally:
+        records.put(None)				# end of records, however the generator ended
+
+
+def fsync_dir(path: str):
+    """Commits the renames in directory path to disk.
+    Ignored where a directory can't be opened, e.g. on Windows.
+
+    Parameters:
+        path (str):			path to the directory
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 
+def rollover():
+    """Thread target: move each closed csv file that is put in rollover_q to its destination.
+    Keeps the poll loop from waiting on the file system's metadata updates.
+    """
+    while True:
+        src, dst = rollover_q.get()
+        try:
+            os.replace(src, dst)
+            fsync_dir(os.path.dirname(dst))
+        except Exception as e:
+            logErr(f"{e} renaming {src} to {dst}")
+        rollover_q.task_done()
+
+
+def table_state(tables: dict) -> dict:
+    """Returns a snapshot of all tables' dynamic state variables
+
+    Parameters:
+        tables (dict):		{tableName:table, ...}
     """
     state = dict()
     for key in tables:				# collect state of each table_name in production
@@ -38,8 +105,63 @@ def write_state(file_name: str, tables: dict):
         state[key] = {'lastId': t.lastId, 'minSec': t.minSec,
             'maxTime': t.maxTime, 'nextPoll': t.nextPoll,
             'recordsPerHour': t.recordsPerHour, 'startPoll': t.startPoll}
-    with open(file_name, 'w') as json_file:
-        json.dump(state, json_file) 	# dump as JSON to file
+    return state
+
+
+def write_state(file_name: str, state: dict):
+    """Writes a snapshot of the tables' state to a JSON file
+    Skips the write when the state is unchanged since the last write. Writes to
+    a temporary file, then atomically replaces file_name.
+
+    Parameters:
+        file_name (str):	file_name to write JSON-encoded state
+        state (dict):		{tableName: {attribute: value, ...}, ...} from table_state
+
+    """
+    global last_state
+    data = json_dumps(state)
+    if data == last_state:			# unchanged since the last write?
+        return						# Yes. Nothing to write
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as json_file:
+        json_file.write(data) 		# write JSON to temporary file
+    os.replace(tmp_name, file_name)  # then atomically replace the file
+    last_state = data
+
+
+def post_state(file_name: str, tables: dict):
+    """Snapshots the tables' state for state_saver to write to file_name
+
+    Parameters:
+        file_name (str):	file_name to write JSON-encoded state
+        tables (dict):		{tableName:table, ...}
+    """
+    global pending_state
+    pending_state = (file_name, table_state(tables))
+    state_dirty.set()
+
+
+def flush_state():
+    """Writes the most recently posted state, if it hasn't been written yet"""
+    with state_lock:
+        if state_dirty.is_set():
+            state_dirty.clear()
+            write_state(*pending_state)
+
+
+def state_saver(period: float):
+    """Thread target: every period seconds, write the posted state, if any.
+    Coalesces the state of successive polls into one write.
+
+    Parameters:
+        period (float):		seconds between writes
+    """
+    while True:
+        time.sleep(period)
+        try:
+            flush_state()
+        except Exception as e:
+            logErr(f"{e} while writing state")
 
 
 def read_state(file_name: str, tables: dict):
@@ -50,8 +172,8 @@ def read_state(file_name: str, tables: dict):
         tables (dict):		{tableName: table, ...}
     """
     try:
-        with open(file_name, 'r') as json_file:
-            states = json.load(json_file)  # read saved state of each table
+        with open(file_name, 'rb') as json_file:
+            states = json_loads(json_file.read())  # read saved state of each table
     except FileNotFoundError:			# file doesn't exist
         print(f"read_state({file_name}) FileNotFoundError. Continuing as if --reset.")
         return
@@ -64,22 +186,46 @@ def read_state(file_name: str, tables: dict):
         if state is not None:			# table_name is in the saved state?
             for attr in fields:			# Yes. import state values
                 # allow a file with deprecated or missing attributes
-                try:
-                    setattr(table, attr, state[attr])
-                except KeyError:
-                    if attr == 'maxTime':
-                        setattr(table, attr, state['maxSec'])  # ***** remove after transition from maxSec to maxTime
+                val = state.get(attr, _MISSING)
+                if val is _MISSING and attr == 'maxTime':
+                    val = state.get('maxSec', _MISSING)  # ***** remove after transition from maxSec to maxTime
+                if val is not _MISSING:
+                    setattr(table, attr, val)
         else:							# No. Note missing state in log
             no_state.append(f"{table.tableName} not in file.")
-        tables_w_key = tables_w_key[1:]
-        for table in tables_w_key: 		# log table(s) that won't be updated
-            no_state.append(f"{table.tablename} {table.version} not updated.")
+        for i in range(1, len(tables_w_key)):  # log table(s) that won't be updated
+            table = tables_w_key[i]
+            no_state.append(f"{table.tableName} {table.version} not updated.")
     if len(no_state) > 0:
         logErr(f"read_state: {' '.join(no_state)}")
 
 
+def write_rows(outfile, writer, rows: list):
+    """Writes each row of field values to outfile as a csv line.
+    A row is joined directly, unless a field contains a csv special character.
+    That rare row is written by the csv writer, which quotes it.
+
+    Parameters:
+        outfile:			the opened csv file
+        writer:				csv.writer on outfile
+        rows (list):		[[field value, ...], ...]
+    """
+    lines = []
+    for row in rows:
+        line = ','.join(['' if v is None else str(v) for v in row])
+        if line.count(',') != len(row) - 1 or '"' in line or '\n' in line or '\r' in line:
+            outfile.write(''.join(lines))  # preserve the order of the rows
+            lines.clear()
+            writer.writerow(row)		# quote the special characters
+        else:
+            lines.append(line + '\r\n')	# csv.writer's default line terminator
+    outfile.write(''.join(lines))
+
+
 change_period = 4 * 60 * 60				# time period for changing output files
 poll_period = 4*60
+batch_size = 1000						# number of records written by each writerows
+flush_period = 15 * 60					# maximum seconds between flushes of the output file
 outputPath = 'collect_cd'				# directory path to output file
 parser = ArgumentParser(description='Write real-time ClientDetails polls to ' + outputPath)
 parser.add_argument('--user', action='store', default=None,
@@ -103,27 +249,36 @@ tbl.set_query_options({'.full': 'true', '.nocount': 'true', 'status': 'ASSOCIATE
 # load table state (reset if no json to read)
 read_state('collect_cd.json', {'ClientDetails': [tbl]})
 # move any previous stranded 'ClientBrief' files from ./{outputPath} to ./files
-brief_pat = r'([0-9]+_)(Client.+).csv'
-for base_name in os.listdir(outputPath):
-    m = re.fullmatch(brief_pat, base_name)
-    if m:
-        try:
-            os.rename(os.path.join(outputPath, base_name),
-                      os.path.join('files', m.group(1) + 'ClientBriefv4.csv'))
-        except Exception as e:
-            logErr(f"{e} while renaming {base_name} to ./files")
+with os.scandir(outputPath) as entries:
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        m = BRIEF_RE.fullmatch(entry.name)
+        if m:
+            try:
+                os.replace(entry.path, os.path.join('files', m.group(1) + 'ClientBriefv4.csv'))
+            except Exception as e:
+                logErr(f"{e} while renaming {entry.name} to ./files")
+fsync_dir('files')						# once, for all of the moved files
 
+threading.Thread(name='rollover', target=rollover, daemon=True).start()
+# write the posted state at most every min(30, poll_period/4) seconds, and on exit
+threading.Thread(name='state_saver', target=state_saver, args=(min(30, poll_period/4),),
+                 daemon=True).start()
+atexit.register(flush_state)
+poll_time = poll_period * (1 + int(time.time() / poll_period))  # first poll time
 while True:								# loop forever
     # start a new output file each change_period
     base_name = f"{str(int(1000 * time.time()))}_{'ClientBrief'}{tbl.version}.csv"
     file_name = os.path.join(outputPath, base_name)
     # start each file with a csv header
-    with open(file_name, mode='w', newline='') as outfile:
-        writer = csv.DictWriter(outfile, field_names, extrasaction='ignore')
-        writer.writeheader()
-        poll_time = poll_period * (1 + int(time.time() / poll_period))
+    with open(file_name, mode='w', newline='', buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(field_names)
         change_time = change_period * (1 + int(poll_time / change_period))
         rec_cnt = 0
+        batch = []						# rows of field values waiting to be written
+        last_flush = time.time()		# time of the most recent flush
         while poll_time < change_time:
             sleep_time = poll_time - time.time()
             if sleep_time > 0:
@@ -132,19 +287,41 @@ while True:								# loop forever
             # Every n minutes, append a batch of new records to outfile
             tbl.polledTime = poll_time
             dupl_cnt = rec_cnt = 0
+            # local aliases for the per-record loop
+            pt = poll_time
+            mac_state_get = mac_state.get
+            mac_state_move_to_end = mac_state.move_to_end
+            batch_append = batch.append
+            # read the poll in a producer thread, while this thread de-dups and writes
+            records = queue.Queue(maxsize=10000)
+            producer = threading.Thread(name='producer', target=produce, daemon=True,
+                args=(tbl.generator(server=my_Cpi, table=tbl, verbose=args.verbose), records))
+            producer.start()
             try:
-                for rec in tbl.generator(server=my_Cpi, table=tbl, verbose=args.verbose):
-                    rec_cnt += 1
+                while True:
+                    rec = records.get()
+                    if rec is None:			# end of records?
+                        break
+                    if isinstance(rec, BaseException):  # generator raised an exception?
+                        raise rec
                     rec['macAddress'] = mac = rec['macAddress']['octets']
                     rec['apMacAddress'] = rec['apMacAddress']['octets']
-                    rec['polledTime'] = poll_time
-                    prev_rec = mac_state.get(mac, None)
-                    if prev_rec is not None and rec['updateTime'] == prev_rec['updateTime']:
-                        dupl_cnt += 1
-                        continue			# ignore oversampled data
+                    rec['polledTime'] = pt
+                    update_time = rec['updateTime']
+                    prev_update = mac_state_get(mac)
+                    if prev_update is not None:
+                        mac_state_move_to_end(mac)  # mac is the most recently seen
+                        if update_time == prev_update:
+                            dupl_cnt += 1
+                            continue		# ignore oversampled data
                     rec_cnt += 1
-                    mac_state[mac] = rec
-                    writer.writerow(rec)
+                    mac_state[mac] = update_time
+                    if len(mac_state) > mac_state_max:
+                        mac_state.popitem(last=False)  # forget the least recently seen mac
+                    batch_append([rec.get(f, '') for f in field_names])
+                    if len(batch) >= batch_size:
+                        write_rows(outfile, writer, batch)
+                        batch.clear()
             except ConnectionAbortedError as ce:
                 # new CPI version returns ConnectionAbortedError when there are no records?
                 print(f"ConnectionAbortedError {ce}")
@@ -152,12 +329,27 @@ while True:								# loop forever
                 # Haven't been able to connect for the last (timeout+240)*(1+2+4+8+16) seconds
                 print(f"ConnectionError {ce}")
                 # just keep waiting for CPI to become available
-            outfile.flush()
+            producer.join()
+            write_rows(outfile, writer, batch)		# write the remaining records
+            batch.clear()
+            # a full buffer is written as it fills. Flush a partial buffer occasionally.
+            # Post the state only for records that are on disk, so a restart can't skip records
+            if time.time() - last_flush > flush_period:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                last_flush = time.time()
+                post_state('collect_cd.json', {'ClientDetails': [tbl]})
             print(f"{strfTime(float(poll_time))} {dupl_cnt} duplicate and {rec_cnt} new records")
-            write_state('collect_cd.json', {'ClientDetails': [tbl]})
-            poll_time = poll_period * (1 + int(time.time() / poll_period))
-    # Move the csv file to ./files
-    try:
-        os.rename(file_name, os.path.join('files', base_name))
-    except Exception as e:
-        logErr(f"{e} renaming file to ./files")
+            now = time.time()
+            poll_time += poll_period	# next poll time
+            if not poll_time - poll_period <= now < poll_time:  # this poll overran the next?
+                poll_time = poll_period * (1 + int(now / poll_period))  # re-align to clock
+        outfile.flush()                 # commit the file's records to disk ...
+        os.fsync(outfile.fileno())
+    post_state('collect_cd.json', {'ClientDetails': [tbl]})  # ... before posting their state
+    # forget the macs that have not been updated recently. updateTime is epoch msec
+    cutoff = 1000 * (time.time() - mac_state_age)
+    for mac in [mac for mac, update_time in mac_state.items() if (update_time or 0) < cutoff]:
+        del mac_state[mac]
+    # Move the csv file to ./files in the background
+    rollover_q.put((file_name, os.path.join('files', base_name)))
@@ -8,26 +8,38 @@ It starts a new file every N hours, and keeps a collection status in collect_cs.
 to facilitate appending only the new polls.
 """
 from argparse import ArgumentParser
+import atexit
 import csv
 import os
 import json
+import threading
 import time
 
 import cpiapi
 from mylib import credentials, logErr
+try:									# orjson is optional, but faster
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    json_loads = json.loads
 """ To Do
 - Fix the CPI database. After an initial read through 8 x 1000001 records, it repeatedly
 sleeps 299 seconds and reads nothing
 """
 
+last_state = None			# JSON bytes most recently written by write_state
+pending_state = None		# (file_name, state) posted for state_saver to write
+state_dirty = threading.Event()	# pending_state has not been written yet
+state_lock = threading.Lock()	# serializes the state_saver and exit writes
+_MISSING = object()			# sentinel for an attribute missing from the saved state
 
-def write_state(file_name: str, tables: dict):
-    """Writes all table's dynamic state variables to a JSON file
+
+def table_state(tables: dict) -> dict:
+    """Returns a snapshot of all table's dynamic state variables
 
     Parameters:
-        file_name (str):	file_name to write JSON-encoded state
         tables (dict):		{tableName:table, ...}
-
     """
     state = dict()
     for key in tables:				# collect state of each table_name in production
@@ -35,8 +47,63 @@ def write_state(file_name: str, tables: dict):
         state[key] = {'lastId': t.lastId, 'minSec': t.minSec,
             'maxTime': t.maxTime, 'nextPoll': t.nextPoll,
             'recordsPerHour': t.recordsPerHour, 'startPoll': t.startPoll}
-    with open(file_name, 'w') as json_file:
-        json.dump(state, json_file) 	# dump as JSON to file
+    return state
+
+
+def write_state(file_name: str, state: dict):
+    """Writes a snapshot of the tables' state to a JSON file
+    Skips the write when the state is unchanged since the last write. Writes to
+    a temporary file, then atomically replaces file_name.
+
+    Parameters:
+        file_name (str):	file_name to write JSON-encoded state
+        state (dict):		{tableName: {attribute: value, ...}, ...} from table_state
+
+    """
+    global last_state
+    data = json_dumps(state)
+    if data == last_state:			# unchanged since the last write?
+        return						# Yes. Nothing to write
+    tmp_name = file_name + '.tmp'
+    with open(tmp_name, 'wb') as json_file:
+        json_file.write(data) 		# write JSON to temporary file
+    os.replace(tmp_name, file_name)  # then atomically replace the file
+    last_state = data
+
+
+def post_state(file_name: str, tables: dict):
+    """Snapshots the tables' state for state_saver to write to file_name
+
+    Parameters:
+        file_name (str):	file_name to write JSON-encoded state
+        tables (dict):		{tableName:table, ...}
+    """
+    global pending_state
+    pending_state = (file_name, table_state(tables))
+    state_dirty.set()
+
+
+def flush_state():
+    """Writes the most recently posted state, if it hasn't been written yet"""
+    with state_lock:
+        if state_dirty.is_set():
+            state_dirty.clear()
+            write_state(*pending_state)
+
+
+def state_saver(period: float):
+    """Thread target: every period seconds, write the posted state, if any.
+    Coalesces the state of successive polls into one write.
+
+    Parameters:
+        period (float):		seconds between writes
+    """
+    while True:
+        time.sleep(period)
+        try:
+            flush_state()
+        except Exception as e:
+            logErr(f"{e} while writing state")
 
 
 def read_state(file_name: str, tables: dict):
@@ -47,8 +114,8 @@ def read_state(file_name: str, tables: dict):
         tables (dict):		{tableName: table, ...}
     """
     try:
-        with open(file_name, 'r') as json_file:
-            states = json.load(json_file)  # read saved state of each table
+        with open(file_name, 'rb') as json_file:
+            states = json_loads(json_file.read())  # read saved state of each table
     except FileNotFoundError:			# file doesn't exist
         print(f"read_state({file_name}) FileNotFoundError. Continuing as if --reset.")
         return
@@ -61,23 +128,47 @@ def read_state(file_name: str, tables: dict):
         if state is not None:			# table_name is in the saved state?
             for attr in fields:			# Yes. import state values
                 # allow a file with deprecated or missing attributes
-                try:
-                    setattr(table, attr, state[attr])
-                except KeyError:
-                    if attr == 'maxTime':
-                        setattr(table, attr, state['maxSec'])  # ***** remove after transition from maxSec to maxTime
+                val = state.get(attr, _MISSING)
+                if val is _MISSING and attr == 'maxTime':
+                    val = state.get('maxSec', _MISSING)  # ***** remove after transition from maxSec to maxTime
+                if val is not _MISSING:
+                    setattr(table, attr, val)
         else:							# No. Note missing state in log
             no_state.append(f"{table.tableName} not in file.")
-        tables_w_key = tables_w_key[1:]
-        for table in tables_w_key: 		# log table(s) that won't be updated
-            no_state.append(f"{table.tablename} {table.version} not updated.")
+        for i in range(1, len(tables_w_key)):  # log table(s) that won't be updated
+            table = tables_w_key[i]
+            no_state.append(f"{table.tableName} {table.version} not updated.")
     if len(no_state) > 0:
         logErr(f"read_state: {' '.join(no_state)}")
 
 
+def write_rows(outfile, writer, rows: list):
+    """Writes each row of field values to outfile as a csv line.
+    A row is joined directly, unless a field contains a csv special character.
+    That rare row is written by the csv writer, which quotes it.
+
+    Parameters:
+        outfile:			the opened csv file
+        writer:				csv.writer on outfile
+        rows (list):		[[field value, ...], ...]
+    """
+    lines = []
+    for row in rows:
+        line = ','.join(['' if v is None else str(v) for v in row])
+        if line.count(',') != len(row) - 1 or '"' in line or '\n' in line or '\r' in line:
+            outfile.write(''.join(lines))  # preserve the order of the rows
+            lines.clear()
+            writer.writerow(row)		# quote the special characters
+        else:
+            lines.append(line + '\r\n')	# csv.writer's default line terminator
+    outfile.write(''.join(lines))
+
+
 change_period = 4 * 60 * 60				# time period for changing output files
 # change_period = 15 * 60				# time period for changing output files
 poll_period = 5*60
+batch_size = 1000						# number of records written by each writerows
+flush_period = 15 * 60					# maximum seconds between flushes of the output file
 outputPath = 'collect_cs'				# directory path to output file
 parser = ArgumentParser(description='Write real-time ClientSessions polls to ' + outputPath)
 parser.add_argument('--user', action='store', default=None,
@@ -99,18 +190,24 @@ tbl.set_pager('hist_pager')
 # load table state (reset if no json to read)
 read_state('collect_cs.json', {'ClientSessions': [tbl]})
 
+# write the posted state at most every min(30, poll_period/4) seconds, and on exit
+threading.Thread(name='state_saver', target=state_saver, args=(min(30, poll_period/4),),
+                 daemon=True).start()
+atexit.register(flush_state)
+poll_time = poll_period * (1 + int(time.time() / poll_period))  # first poll time
 while True:								# loop forever
     # start a new output file each change_period
     file_name = os.path.join(
         outputPath,
         f"{str(int(1000 * time.time()))}_{tbl.tableName}{tbl.version}.csv")
     # start each file with a csv header
-    with open(file_name, mode='w', newline='') as outfile:
-        writer = csv.DictWriter(outfile, field_names, extrasaction='ignore')
-        writer.writeheader()
-        poll_time = poll_period * (1 + int(time.time() / poll_period))
+    with open(file_name, mode='w', newline='', buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(field_names)
         change_time = change_period * (1 + int(poll_time / change_period))
         rec_cnt = 0
+        batch = []						# rows of field values waiting to be written
+        last_flush = time.time()		# time of the most recent flush
         while poll_time < change_time:
             sleep_time = poll_time - time.time()
             if sleep_time > 0:
@@ -118,16 +215,35 @@ while True:								# loop forever
                 time.sleep(sleep_time)
             # Every 5 minutes, append a batch of new records to outfile
             tbl.polledTime = poll_time
+            # local aliases for the per-record loop
+            pt = poll_time
+            batch_append = batch.append
             for rec in tbl.generator(server=my_Cpi, table=tbl):
                 rec_cnt += 1
                 rec['macAddress'] = rec['macAddress']['octets']
                 rec['apMacAddress'] = rec['apMacAddress']['octets']
-                rec['polledTime'] = poll_time
-                writer.writerow(rec)
+                rec['polledTime'] = pt
+                batch_append([rec.get(f, '') for f in field_names])
+                if len(batch) >= batch_size:
+                    write_rows(outfile, writer, batch)
+                    batch.clear()
                 if rec_cnt > 1000000:
                     print(f"{rec_cnt} records")
                     rec_cnt = 0
                     break
-            outfile.flush()
-            write_state('collect_cs.json', {'ClientSessions': [tbl]})
-            poll_time = poll_period * (1 + int(time.time() / poll_period))
+            write_rows(outfile, writer, batch)		# write the remaining records
+            batch.clear()
+            # a full buffer is written as it fills. Flush a partial buffer occasionally.
+            # Post the state only for records that are on disk, so a restart can't skip records
+            if time.time() - last_flush > flush_period:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                last_flush = time.time()
+                post_state('collect_cs.json', {'ClientSessions': [tbl]})
+            now = time.time()
+            poll_time += poll_period	# next poll time
+            if not poll_time - poll_period <= now < poll_time:  # this poll overran the next?
+                poll_time = poll_period * (1 + int(now / poll_period))  # re-align to clock
+        outfile.flush()                 # commit the file's records to disk ...
+        os.fsync(outfile.fileno())
+    post_state('collect_cs.json', {'ClientSessions': [tbl]})  # ... before posting their state
@@ -6,16 +6,25 @@ Compares parallel production, e.g. from different versions, in 'files' and 'prod
 """
 
 from argparse import ArgumentParser
+from array import array
+from collections import defaultdict
+import contextlib
 import csv
 import functools
+import heapq
+import multiprocessing
+import operator
 import os
-import statistics
+import shutil
 import sys
+import tempfile
 
 import awslib
 from cpiapi import all_table_dicts, find_table, numericTypes, SubTable, Table
 from mylib import strfTime, verbose_1
 
+from _util import prefetch
+
 """ TO DO
 When CPI is inserting, modifying, and deleting records while a collection
 process that is collecting the state of these records, the collection
@@ -43,10 +52,14 @@ files\1586036874403_HistoricalRFStatsv4.csv: [97411507250]:[97427876316]
     16257 records ignored with prod\1586000874489_ and prod\1586054874753_
 files\1586126874408_HistoricalRFStatsv4.csv vs prod\1586126875074: 1402 at and vs sum=1355 distributed
 Report compare_rec summary
+If compare() itself becomes the bottleneck, consider compiling its two-pointer
+merge (e.g. with Cython) over integer key columns. Numba's nopython mode
+can't consume the csv_files generators or the lists of str field values.
 """
 col_width = 30
 max_diff = 20			# Limit for number of cases per table attribute to report
 spaces = ' '*col_width					# column width for columnar output
+_SENTINEL = object()					# next(source, _SENTINEL) when source is exhausted
 
 
 def compare(sources: list, source_names: list, transform: callable,
@@ -63,14 +76,18 @@ def compare(sources: list, source_names: list, transform: callable,
 
     """
     rec_cnt = list(0 for i in range(len(sources)))  # count of records in each source
+    show_keys = verbose > 0				# print each key compared?
 
-    def end_skipped(i: int):
-        nonlocal count, start_keys, end_keys, source_names, verbose
-        if count > 0 and start_keys[i] is not None:
-            if verbose > 1:
+    if verbose > 1:						# report each sequence of skipped records?
+        def end_skipped(i: int):
+            nonlocal count, start_keys, end_keys, source_names
+            if count > 0 and start_keys[i] is not None:
                 print(f"{spaces*i}{start_keys[i]}:{end_keys[i]} {count} record{'s' if count>1 else ''} ignored.")
-            start_keys[i] = None
-            count = 0
+                start_keys[i] = None
+                count = 0
+    else:								# No. The skip tracking is only for this report
+        def end_skipped(i: int):
+            pass
 
     def extend(i: int):
         nonlocal count, start_keys, end_keys, transform, rec_cnt
@@ -78,19 +95,29 @@ def compare(sources: list, source_names: list, transform: callable,
             start_keys[i] = keys[i]
         end_keys[i] = keys[i]
         count += 1
-        recs[i] = get_rec(sources[i], transform)
-        rec_cnt[i] += 0 if recs[i] is None else 1
-        keys[i] = None if recs[i] is None else key_func(recs[i])
-
-    recs = [get_rec(sources[0], transform), get_rec(sources[1], transform)]
-    for i in (0, 1):
-        rec_cnt[i] += 0 if recs[0] is None else 1
-    keys = [None if recs[i] is None else key_func(recs[i]) for i in range(len(recs))]
+        rec = next(sources[i], _SENTINEL)
+        if rec is _SENTINEL:			# source is exhausted?
+            recs[i] = keys[i] = None
+        else:
+            transform(rec)
+            rec_cnt[i] += 1
+            recs[i] = rec
+            keys[i] = key_func(rec)
+
+    recs = [None, None]
+    keys = [None, None]
+    for i in (0, 1):					# first record of each stream
+        rec = next(sources[i], _SENTINEL)
+        if rec is not _SENTINEL:
+            transform(rec)
+            rec_cnt[i] += 1
+            recs[i] = rec
+            keys[i] = key_func(rec)
     count = 0							# count of sequence of un_matched records
     start_keys = [None, None]
     end_keys = [None, None]
     while recs[0] is not None and recs[1] is not None:  # while there are 2 streams
-        if verbose > 0:
+        if show_keys:
             print(f"{str(keys[0]):30}{keys[1]}")
         if keys[0] < keys[1]:
             end_skipped(1)				# complete possible skipping of stream 1
@@ -103,26 +130,34 @@ def compare(sources: list, source_names: list, transform: callable,
             k = keys[0]
             for i in range(len(sources)):  # for each stream
                 end_skipped(i)			# complete possible skipping
-                recs[i] = get_rec(sources[i], transform)  # get new record
-                rec_cnt[i] += 0 if recs[i] is None else 1
-                keys[i] = None if recs[i] is None else key_func(recs[i])
+                rec = next(sources[i], _SENTINEL)  # get new record
+                if rec is _SENTINEL:	# source is exhausted?
+                    recs[i] = keys[i] = None
+                else:
+                    transform(rec)
+                    rec_cnt[i] += 1
+                    recs[i] = rec
+                    keys[i] = key_func(rec)
             if len(text) > 0:
                 print(f"{k}: {text}") 	# output notes from record processing
     i = 0 if recs[0] is not None else 1 if recs[1] is not None else None
     if i is not None:					# is one stream still remaining?
         end_skipped(1-i)				# end skipping in the fn stream
         while True:
-            if verbose > 0:
+            if show_keys:
                 print(f"{spaces*i}{keys[i]} alone")
             if count == 0:
                 start_keys[i] = keys[i]
             end_keys[i] = keys[i]
             count += 1
-            recs[i] = get_rec(sources[i], transform)
-            rec_cnt[i] += 0 if recs[i] is None else 1
-            if recs[i] is None:
+            rec = next(sources[i], _SENTINEL)
+            if rec is _SENTINEL:		# source is exhausted?
+                recs[i] = None
                 break
-            keys[i] = key_func(recs[i])
+            transform(rec)
+            rec_cnt[i] += 1
+            recs[i] = rec
+            keys[i] = key_func(rec)
         end_skipped(i)					# report any final skipped records
     if verbose > 0:
         print(f"{rec_cnt[0]:26} {'==' if rec_cnt[0]==rec_cnt[1] else '!='} {rec_cnt[1]}")
@@ -145,59 +180,46 @@ def compare_diff(table: SubTable) -> str:
     return ', '.join(diff)
 
 
-def compare_rec(recs: list, keys: list, table: SubTable) -> str:
+def compare_rec(recs: list, keys: list, table: SubTable, select_pos: list,
+                select_get: callable) -> str:
     """Compare each data field of the 2 records. Reporting differences into result.
 
     Parameters:
-        recs:		[record from a, record from b]
-        keys:		???
+        recs:		[record from a, record from b], each a list of values in table.select order
+        keys:		primary key values, excluding polledTime, shared by both records. Unused
         table:		SubTable definition
+        select_pos:	[(position, attribute name), ...] of each field to compare
+        select_get:	function(rec) returns the values of the fields to compare
 
     Returns:		difference text
     """
-
-    def post_diff(attr: str):
-        """Accumulate difference in records[attr] to nonlocal result."""
-        nonlocal recs, table, result
-        global max_diff
-        if recs[0][attr] == recs[1][attr]:
-            return						# fields are equal -- nothing to say
-        try:  # increment inequality count for attr
-            table.field_counts[attr] += 1
-        except KeyError:
-            table.field_counts[attr] = 1
-        if table.field_counts[attr] > max_diff:  # report the difference?
-            return						# No
-        if table.field_counts[attr] == max_diff:  # last time?
-            s = f", {attr}(...,...)"
-
-        s = f", {attr}({recs[0].get(attr, None)},{recs[1].get(attr, None)})"
-        result += s						# post attribute difference
-
+    a, b = recs
+    if select_get(a) == select_get(b):	# all compared fields are equal?
+        return ''						# Yes. Nothing to report
     result = ''							# initially nothing to report
-    attrs = table.select				# All attributes
-    for attr in attrs:					# compare each field
-        if attr == 'polledTime': 		# Except never compare the 'polledTime'
-            continue
-        try:
-            post_diff(attr)
-        except KeyError:				# one or both records missing attr
-            post_diff(attr)
+    fc = table.field_counts				# {attr: count of differences, ...}
+    for i, attr in select_pos:
+        if a[i] != b[i]:
+            fc[attr] += 1				# increment inequality count for attr
+            if fc[attr] <= max_diff:	# report the difference?
+                result += f", {attr}({a[i]},{b[i]})"  # Yes. post attribute difference
     if len(result) > 2:
         return result[2:]
     else:
         return ''
 
 
-def csv_files(file_list: list, transform: callable, key_func: callable,
+def csv_files(file_list: list, columns: list, transform: callable, key_func: callable,
             formatter: callable = print, verbose: int = 0):
     """Generator to read a list of csv files.
-    Yields dict generated by DictReader.
+    Yields each record as a list of its values in columns order, with None for
+    a value that is missing from the file.
     Drops records that key function classifies as in non-ascending order.
 
     Parameters:
         file_list (list):		[{'prefix': str, 'msec': int, 'tablename': str,
                             'version': int, 'suffix': str, 'file_name': str)}, ...]}
+        columns (list):			[column name, ...] order of the values in each record
         transform (callable):	called w/ each record for field transformations
         key_func (callable):	key function
         formatter (callable):	function to output messages
@@ -218,11 +240,22 @@ def csv_files(file_list: list, transform: callable, key_func: callable,
     for file in file_list: 				# for each file in file list
         file_name = os.path.join(file['prefix'], file['file_name'])
         time_stamp = strfTime(int(file['msec']))
-        with open(file_name, 'r', newline='') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
+        with open(file_name, 'r', newline='', buffering=1 << 20) as csv_file:
+            if hasattr(os, 'posix_fadvise'):  # hint that the file will be read sequentially
+                os.posix_fadvise(csv_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            csv_reader = csv.reader(csv_file)
+            header = next(csv_reader, [])  # column names in this file
+            name_to_pos = {name: i for i, name in enumerate(header)}
+            positions = [name_to_pos.get(name) for name in columns]  # position of each column
+            in_order = header == columns  # file's columns are already in columns order?
+            width = len(columns)
             rec_cnt = 0
-            delta_list = []				# list of keys[0]-keys_old[0]
-            for rec in csv_reader: 		# Read each dict returned by DictReader
+            delta_list = array('q')		# keys[0]-keys_old[0] of each record, when verbose
+            for rec in csv_reader: 		# Read each row returned by csv.reader
+                if not rec:				# skip a blank line, as DictReader does
+                    continue
+                if not in_order or len(rec) != width:  # reorder, and fill missing values
+                    rec = [None if p is None or p >= len(rec) else rec[p] for p in positions]
                 transform(rec)
                 keys = key_func(rec)
                 if rec_cnt == 0: 		# first record of the file?
@@ -235,14 +268,14 @@ def csv_files(file_list: list, transform: callable, key_func: callable,
                     yield rec 			# No previous record. Yield new record
                     msg_put()
                 else:					# Yes, there is a previous record
-                    if len(keys) > 0:
+                    if verbose > 0 and len(keys) > 0:
                         delta_list.append(keys[0]-keys_old[0])
                     if keys_old <= keys:  # old <= rec?
                         if verbose > 1 and len(keys) > 0:  # Check for missing key values?
                             try:
                                 if int(keys[0]) != int(keys_old[0]) + 1:
-                                    a = keys_old.copy()
-                                    b = keys.copy()
+                                    a = list(keys_old)
+                                    b = list(keys)
                                     a[0] = int(a[0])+1
                                     b[0] = int(b[0])-1
                                     msg2.append(f"{a}:{b} key{'s' if b[0]>a[0] else ''} missing")
@@ -253,7 +286,7 @@ def csv_files(file_list: list, transform: callable, key_func: callable,
                                 + f"out of order record{'s' if discards>1 else ''}"
                                 + " discarded.")
                         discards = 0 	# End of block of out-of-order records
-                        keys_old = keys.copy()
+                        keys_old = keys
                         msg_put()
                         yield rec 		# yield the record
                         msg_put()
@@ -272,7 +305,8 @@ def csv_files(file_list: list, transform: callable, key_func: callable,
                     start = 0
                     while start < len(delta_list):
                         next_start = start+buc_size
-                        buckets.append(int(statistics.mean(delta_list[int(start):int(next_start)])))
+                        bucket = delta_list[int(start):int(next_start)]
+                        buckets.append(int(sum(bucket)/len(bucket)))
                         start = next_start
                     msg.append(f"{buckets}")
                 msg.append(f"{keys_prev} Closed {file_name}")
@@ -287,37 +321,24 @@ def csv_files(file_list: list, transform: callable, key_func: callable,
     return
 
 
-def get_rec(iterator: callable, transform: callable):
-    """Get one record from iterable, returning None on StopIteration
-
-    Parameters:
-        iterator:		iterable that returns a record
-        transform:		???
-    """
-    try:
-        rec = next(iterator)
-        # rec = iterator.__next__()
-        transform(rec)
-        return rec
-    except StopIteration:				# source is exhausted
-        return None
-
-
-def key_func_template(rec: dict, keys: list) -> list:
-    """Key function that returns a composite key for rec.
+def make_key_func(keys: list) -> callable:
+    """Returns a key function that returns a composite key for a record.
 
     Parameters:
-        rec:		a record
-        keys:		list of key names
+        keys:		list of the key columns' positions in the record
 
-    Returns:		list of key values
+    Returns:		key function(rec) that returns the tuple of key values
     """
-    return [rec[x] for x in keys]
+    if len(keys) == 0:
+        return lambda rec: ()
+    if len(keys) == 1:
+        return lambda rec, k=keys[0]: (rec[k],)
+    return operator.itemgetter(*keys)
 
 
 def merge(sources: list, transform: callable, key_func: callable,
         de_dup: callable, verbose: int = 0):
-    """Merge N dict streams
+    """Merge N sorted record streams
     Parameters:
         sources (list):			[generator, ...]
         transform (callable):	apply transform(record) to each record
@@ -326,45 +347,183 @@ def merge(sources: list, transform: callable, key_func: callable,
         verbose (int):			increase diagnostic message level beyond default=0
 
     """
-    rec_cnt = list(None for i in range(len(sources)))
-    active = []
+    rec_cnt = [0 for i in range(len(sources))]
+    active = []							# heap of (key, source index, record)
+
+    def replenish(source: int):
+        """Push the next record, if any, from sources[source] onto active."""
+        rec = next(sources[source], _SENTINEL)
+        if rec is not _SENTINEL:  		# another record in this stream?
+            transform(rec)
+            rec_cnt[source] += 1
+            heapq.heappush(active, (key_func(rec), source, rec))
+
     for i in range(len(sources)):
-        rec = get_rec(sources[i], transform)
-        rec_cnt[i] += 0 if rec is None else 1
-        if rec is not None:
-            active.append((key_func(rec), i, rec))
-    while len(active) >= 2:				# while 2 or more streams remain
-        active.sort()					# identify the 2 with lowest key values
-        a, b = active[0], active[1] 	# 2 streams with lowest keys
-        if a[0] == b[0]:  				# Records have equal keys.
-            index = de_dup(a[2], b[2])  # Which record to drop?
-            if index is not None: 		# one to be dropped?
-                active.pop(index)
+        replenish(i)
+    while active:
+        key, source, rec = heapq.heappop(active)  # record with the lowest key
+        if active and active[0][0] == key:  # next lowest has an equal key?
+            index = de_dup(rec, active[0][2])  # Yes. Which record to drop?
+            if index == 0:				# drop this record
+                replenish(source)
+                continue
+            if index == 1:				# drop the other record
+                replenish(heapq.heappop(active)[1])
+                heapq.heappush(active, (key, source, rec))
                 continue
             # No, neither to be dropped
-            x, source, rec = active.pop(0)  # Output 1st
-            yield rec  # output
-            rec = get_rec(sources[source], transform)
-            rec_cnt[source] += 0 if rec is None else 1
-            if rec is not None:  		# another record in this stream?
-                active.append([key_func(rec), source, rec])  # replenish
-    while len(active) >= 1:				# Yield the remainder of the last source
-        x, source, rec = active.pop(0)  # Output 1st
-        yield rec  # output
-        rec = get_rec(sources[source], transform)
-        rec_cnt[source] += 0 if rec is None else 1
-        if rec is not None:  			# another record in this stream?
-            active.append([key_func(rec), source, rec])  # replenish
+        yield rec  						# output
+        replenish(source)
 
 
 def my_columns(text: object, column: int):
     print(f"{' '*col_width*column}{str(text)}")
 
 
-def to_int(rec: dict, keys: list):
-    """Convert each rec[keys[i]] to int."""
+def make_to_int(keys: list) -> callable:
+    """Returns a function to_int(rec) that converts each rec[keys[i]] to int.
+    The function is compiled with the positions as constants, so each record
+    is converted without a loop over keys. It parses a plain integer with int(),
+    and only falls back to float() for any other number.
+
+    Parameters:
+        keys:		column positions in rec
+
+    Returns:		to_int(rec) function
+    """
+    lines = ['def to_int(rec):']
     for key in keys:
-        rec[key] = int(float(rec[key]))  # allow N+ or n*.N*
+        lines += ['    try:',
+                  f'        rec[{int(key)}] = int(rec[{int(key)}])',
+                  '    except ValueError:',
+                  f'        rec[{int(key)}] = int(float(rec[{int(key)}]))']  # allow N+ or n*.N*
+    if len(keys) == 0:
+        lines.append('    pass')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['to_int']
+
+
+def compare_table(table_name: str, data_sets: list, source_paths: list, verbose: int = 0) -> str:
+    """Compare the csv files for table_name in each data_set.
+    Runs in a worker process, so writes the report to a temporary file rather than
+    printing it or holding it in memory. The caller prints and removes the file.
+
+    Parameters:
+        table_name (str):		name of the table to compare
+        data_sets (list):		[{tablename: [file, ...], ...}, ...] for each source
+        source_paths (list):	[path to source directory, ...]
+        verbose (int):			increase diagnostic messages over default=0
+
+    Returns:					name of the report file
+    """
+    with tempfile.NamedTemporaryFile('w', prefix=f"compare_{table_name}_", suffix='.txt',
+                                     delete=False) as out:
+        try:
+            with contextlib.redirect_stdout(out):
+                _compare_table(table_name, data_sets, source_paths, verbose)
+        except BaseException:
+            out.close()
+            os.remove(out.name)			# don't leave a partial report behind
+            raise
+    return out.name
+
+
+def print_report(file_name: str):
+    """Copy a report file from compare_table to stdout, then remove the file.
+
+    Parameters:
+        file_name (str):		name of the report file
+    """
+    try:
+        with open(file_name) as report:
+            shutil.copyfileobj(report, sys.stdout)
+    finally:
+        os.remove(file_name)
+
+
+def _compare_table(table_name: str, data_sets: list, source_paths: list, verbose: int):
+    """Compare the csv files for table_name in each data_set, printing the report"""
+    print(f"\nPROCESSING {table_name} FILES")
+    table = find_table(table_name, all_table_dicts)
+    if table is None:
+        print(f"Cant find definition for {table_name}. Skipping this table.")
+        return
+    table.field_counts = defaultdict(int)  # {attr: count of differences, ...}
+    # each record is a list of values in table.select order, then any other key columns
+    columns = list(table.select)
+    for k in table.key_defs:
+        if k[1] not in columns:
+            columns.append(k[1])
+    col_pos = {name: i for i, name in enumerate(columns)}
+    # supply keys:list so  call is key_func(rec)
+    keys = []
+    for k in table.key_defs:
+        if k[1] != 'polledTime': 	# drop 'polledTime' key for record compares
+            keys.append(col_pos[k[1]])
+    key_func = make_key_func(keys)
+    if table_name not in {'sites'}:  # retrieval ordered by primary key(s)?
+        order_func = key_func
+    else:							# No, do not insist on ordered records
+        order_func = make_key_func([])
+
+    numeric = []					# list of keys to be transformed to int
+    for key in table.key_defs:
+        if key[0] in numericTypes:
+            numeric.append(col_pos[key[1]])
+    transform = make_to_int(numeric)
+
+    generators = []					# generator for this table in each data_set
+    for i in range(len(data_sets)):
+        formatter = functools.partial(my_columns, column=i)  # columnar generator messages
+        if table_name in data_sets[i]:
+            # create a record generator for this source
+            generator = csv_files(file_list=data_sets[i][table_name],
+                columns=columns, transform=transform, key_func=order_func, formatter=formatter,
+                verbose=verbose_1(verbose))
+            generators.append(generator if verbose_1(verbose) > 0 else prefetch(generator))
+        else:
+            print(f"{spaces*i}{table_name} not in {source_paths[i]}")
+    if len(generators) != len(data_sets):  # table_name missing from some source(s)
+        print(f"{table_name} will not be compared")
+        return
+    # position of each attribute to compare. Never compare the 'polledTime'
+    select_pos = [(i, attr) for i, attr in enumerate(table.select) if attr != 'polledTime']
+    if len(select_pos) > 0:
+        select_get = operator.itemgetter(*[i for i, attr in select_pos])
+    else:
+        select_get = make_key_func([])
+    rec_func = functools.partial(compare_rec, table=table, select_pos=select_pos,
+                                 select_get=select_get)
+    if table_name == ('ClientSessions' or isinstance(table, Table) and table.polled
+            or table.parent is not None and table.parent.polled):
+        # Compare corresponding files one at a time
+        common = min(len(data_sets[0][table_name]), len(data_sets[1][table_name]))
+        for j in range(common):
+            generators = []
+            for i in (0, 1):
+                formatter = functools.partial(my_columns, column=i)  # columnar generator messages
+                generator = csv_files(file_list=[data_sets[i][table_name][j]],
+                    columns=columns, transform=transform, key_func=order_func,
+                    formatter=formatter, verbose=verbose_1(verbose))
+                generators.append(generator if verbose_1(verbose) > 0 else prefetch(generator))
+            compare(sources=generators, source_names=source_paths,
+                    transform=transform, key_func=key_func, rec_func=rec_func,
+                    verbose=verbose_1(verbose))
+        # report any extra files in one of the dataSets
+        longer = 0 if len(data_sets[0]) > len(data_sets[1]) else 1
+        if len(data_sets[longer][table_name]) > common:
+            print(f"{' '*col_width*longer}Extra files not compared:")
+            for i in range(common, len(data_sets[longer][table_name])):
+                print(f"{' ' * col_width * longer}{data_sets[longer][table_name][i]}")
+
+    else:					# Compare all files for a table in a combined stream
+        compare(sources=generators, source_names=source_paths,
+                transform=transform, key_func=key_func, rec_func=rec_func,
+                verbose=verbose_1(verbose))
+    s = compare_diff(table)		# report count of differences for each field
+    if len(s) > 0:
+        print(s)
 
 
 if __name__ == '__main__':
@@ -405,68 +564,13 @@ if __name__ == '__main__':
     print(f"Comparing contents of {source_paths[0]} to {source_paths[1]} directories")
     if args.verbose > 0:
         print(f"for tables: {table_names}")
-    for table_name in table_names:		# for each table with csv file(s)
-        print(f"\nPROCESSING {table_name} FILES")
-        table = find_table(table_name, all_table_dicts)
-        if table is None:
-            print(f"Cant find definition for {table_name}. Skipping this table.")
-            continue
-        # supply keys:list so  call is key_func(rec)
-        keys = []
-        for k in table.key_defs:
-            if k[1] != 'polledTime': 	# drop 'polledTime' key for record compares
-                keys.append(k[1])
-        key_func = functools.partial(key_func_template, keys=keys)
-        if table_name not in {'sites'}:  # retrieval ordered by primary key(s)?
-            order_func = functools.partial(key_func_template, keys=keys)
-        else:							# No, do not insist on ordered records
-            order_func = functools.partial(key_func_template, keys=[])
-
-        numeric = []					# list of keys to be transformed to int
-        for key in table.key_defs:
-            if key[0] in numericTypes:
-                numeric.append(key[1])
-        transform = functools.partial(to_int, keys=numeric)
-
-        generators = []					# generator for this table in each data_set
-        for i in range(len(data_sets)):
-            formatter = functools.partial(my_columns, column=i)  # columnar generator messages
-            if table_name in data_sets[i]:
-                # create a record generator for this source
-                generators.append(csv_files(file_list=data_sets[i][table_name],
-                    transform=transform, key_func=order_func, formatter=formatter,
-                    verbose=verbose_1(args.verbose)))
-            else:
-                print(f"{spaces*i}{table_name} not in {source_paths[i]}")
-        if len(generators) != len(data_sets):  # table_name missing from some source(s)
-            print(f"{table_name} will not be compared")
-            continue
-        rec_func = functools.partial(compare_rec, table=table)
-        if table_name == ('ClientSessions' or isinstance(table, Table) and table.polled
-                or table.parent is not None and table.parent.polled):
-            # Compare corresponding files one at a time
-            common = min(len(data_sets[0][table_name]), len(data_sets[1][table_name]))
-            for j in range(common):
-                generators = []
-                for i in (0, 1):
-                    formatter = functools.partial(my_columns, column=i)  # columnar generator messages
-                    generators.append(csv_files(file_list=[data_sets[i][table_name][j]],
-                        transform=transform, key_func=order_func,
-                        formatter=formatter, verbose=verbose_1(args.verbose)))
-                compare(sources=generators, source_names=source_paths,
-                        transform=transform, key_func=key_func, rec_func=rec_func,
-                        verbose=verbose_1(args.verbose))
-            # report any extra files in one of the dataSets
-            longer = 0 if len(data_sets[0]) > len(data_sets[1]) else 1
-            if len(data_sets[longer][table_name]) > common:
-                print(f"{' '*col_width*longer}Extra files not compared:")
-                for i in range(common, len(data_sets[longer][table_name])):
-                    print(f"{' ' * col_width * longer}{data_sets[longer][table_name][i]}")
-
-        else:					# Compare all files for a table in a combined stream
-            compare(sources=generators, source_names=source_paths,
-                    transform=transform, key_func=key_func, rec_func=rec_func,
-                    verbose=verbose_1(args.verbose))
-        s = compare_diff(table)		# report count of differences for each field
-        if len(s) > 0:
-            print(s)
+    if args.verbose > 0:
+        # per-key diagnostics are voluminous. Compare in this process, streaming the output
+        for table_name in table_names:
+            _compare_table(table_name, data_sets, source_paths, args.verbose)
+    elif len(table_names) > 0:
+        # compare the tables in parallel, printing each table's report in table_name order
+        with multiprocessing.Pool(min(len(table_names), os.cpu_count() or 1)) as pool:
+            for file_name in pool.imap(functools.partial(compare_table, data_sets=data_sets,
+                    source_paths=source_paths, verbose=args.verbose), table_names):
+                print_report(file_name)
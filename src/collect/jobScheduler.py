@@ -15,11 +15,20 @@ Not implemented because the performance of successive releases of Cisco's CPI so
 dramatically declined such that more frequent sampling could not be supported.
 
 """
-import io
+import heapq
 import json
 import time
-from typing import Dict, Union
-from io import TextIOWrapper
+from typing import BinaryIO, Dict, List, Tuple, Union
+try:                                    # POSIX file locking
+    import fcntl
+except ImportError:                     # e.g. Windows. Rely on the open failing while locked
+    fcntl = None
+try:                                    # orjson is optional, but faster
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+    json_loads = json.loads
 
 
 class JobScheduler:
@@ -28,6 +37,7 @@ class JobScheduler:
     """
     # The maintained dynamic attributes
     fields = ('lastId', 'minSec', 'lastSec', 'maxTime', 'nextPoll', 'recordsPerHour', 'startPoll')
+    _fields_set = frozenset(fields)
     jobDefault = dict.fromkeys(fields, 0.0)
     goodEnough: float = 3.0     # start job iff scheduled time is < goodEnough seconds in the future
     maxTime = time.time() + 10*365*24*60*60*1000  # 10 years from now
@@ -41,7 +51,9 @@ class JobScheduler:
         :param jobsDict:    filename of the jobs dict, or a jobs dict to use instead
         """
         self.jobsDict = jobsDict  # filename of the jobs dict, or a jobs dict to use instead
-        self.jsonFile: Union[TextIOWrapper, None] = None  # opened File, or None iff file is not opened
+        self.jsonFile: Union[BinaryIO, None] = None  # opened File, or None iff file is not opened
+        self._heap: List[Tuple[float, str]] = []  # [(nextPoll, tableName), ...] possibly stale
+        self._heapDict: Union[Dict[str, Dict[str, float]], None] = None  # isolated job dict indexed by _heap
 
     def post_get(self, completed: Union[Dict[str, Dict[str, float]], None]) -> Dict[str, Dict[str, float]]:
         """Post completion of the completed job. Sleep until returning the next job.
@@ -51,8 +63,8 @@ class JobScheduler:
         if isinstance(completed, dict):
             # verify completed job has expected structure
             tableName, attributes = completed.popitem()
-            if set(attributes.keys()) != set(self.fields):
-                raise ValueError("missing/extra keys in {tablename} attributes: {tableValues}")
+            if attributes.keys() != self._fields_set:
+                raise ValueError(f"missing/extra keys in {tableName} attributes: {attributes}")
         elif completed is None:
             tableName = None
             attributes = None           # make IDE happy
@@ -64,15 +76,14 @@ class JobScheduler:
             try:                        # ensure that jobs file is unlocked, despite exception
                 if tableName:           # update provided?
                     jd[tableName] = attributes.copy()  # Yes. post it
+                    self._push(jd, tableName)
                 # find the next job to process -- job with minimum nextPoll
-                key = jd.keys().__iter__().__next__()  # initial guess
-                for k, v in jd.items():
-                    if v['nextPoll'] < jd[key]['nextPoll']:
-                        key = k
+                key = self._next_job(jd)
                 seconds = jd[key]['nextPoll'] - time.time()  # seconds to scheduled time
                 if seconds < self.goodEnough:  # very soon?
                     timeout = jd.copy()  # Yes.
                     timeout[key]['nextPoll'] += self.timeOut  # when eligible again if not completed
+                    self._push(jd, key)
                     self._putJobsDict(jd)  # Write_back and release jobs dict
                     return {key: jd[key].copy()}    # return a job to do
                 self._putJobsDict(jd if tableName else None)  # update & release
@@ -83,6 +94,37 @@ class JobScheduler:
                 self._putJobsDict(jd if tableName else None)  # update & release
                 raise Exception(exc)
 
+    def _next_job(self, jd: Dict[str, Dict[str, float]]) -> str:
+        """Return the tableName of the job in jd with the minimum nextPoll.
+        Of jobs with equal nextPoll: the first in a shared file's dict,
+        or the least tableName in an isolated dict
+
+        :param jd:          the job dictionary
+        :return:            tableName
+        """
+        if not isinstance(self.jobsDict, dict):  # shared file, re-read on every call?
+            return min(jd, key=lambda k: jd[k]['nextPoll'])  # Yes. a heap would not be reused
+        if jd is not self._heapDict or len(self._heap) > 2*len(jd) + 16:  # heap isn't usable?
+            self._heap = [(v['nextPoll'], k) for k, v in jd.items()]  # (re)build it
+            heapq.heapify(self._heap)
+            self._heapDict = jd
+        heap = self._heap
+        while True:
+            nextPoll, key = heap[0]
+            job = jd.get(key)
+            if job is not None and job['nextPoll'] == nextPoll:  # current?
+                return key
+            heapq.heappop(heap)         # No. Discard the stale entry
+
+    def _push(self, jd: Dict[str, Dict[str, float]], key: str):
+        """Add jd[key]'s current nextPoll to the heap, if the heap indexes jd
+
+        :param jd:          the job dictionary
+        :param key:         tableName of the updated job
+        """
+        if jd is self._heapDict:
+            heapq.heappush(self._heap, (jd[key]['nextPoll'], key))
+
     def _getJobsDict(self) -> Dict[str, Dict[str, float]]:
         """Obtain exclusive access to job dictionary and return it
 
@@ -95,7 +137,7 @@ class JobScheduler:
         elif isinstance(self.jobsDict, str):  # No. Filename of shared file?
             while True:                 # Yes. Obtain exclusive access
                 try:
-                    self.jsonFile = open(self.jobsDict, mode='r+')
+                    self.jsonFile = open(self.jobsDict, mode='rb+')
                 except FileNotFoundError as fnf:
                     print("ERROR no jobDicts file", fnf)
                     raise FileNotFoundError(fnf)
@@ -104,26 +146,35 @@ class JobScheduler:
                     time.sleep(self.retrySeconds)
                     continue            # keep trying
                 # successfully opened the file
-                states = json.load(self.openfile)
+                if fcntl is not None:   # wait in the kernel for exclusive access
+                    fcntl.flock(self.jsonFile.fileno(), fcntl.LOCK_EX)
+                states = json_loads(self.jsonFile.read())
                 return states
         else:                           # internal error
             raise TypeError(f"self.jobDict type is {type(self.jobsDict)}: {self.jobsDict}")
 
     def _putJobsDict(self, jobDict: Union[Dict[str, Dict[str, float]], None]):
-        """Put completed job [if present] back into the schedule
+        """Put the updated job dictionary [if changed] back into the schedule, and release it
 
-        :param jobDict:     the job, or None if no job
+        :param jobDict:     the updated job dictionary, or None if unchanged
         :return:
         """
-        if isinstance(jobDict, dict):   # local isolated job dictionary?
-            self.jobsDict = jobDict     # Yes. replace with updated copy
+        if isinstance(self.jobsDict, dict):  # local isolated job dictionary?
+            if jobDict is not None:     # Yes. replace with updated copy
+                self.jobsDict = jobDict
             return
-        elif isinstance(jobDict, str):  # No. Filename of shared file?:
-            self.jsonFile.seek(0, __whence=io.SEEK_SET)  # Yes.
-            self.jsonFile.truncate(0)   # Truncate to zero size
-            json.dump(jobDict, self.jsonFile)  # and write back to shared file
-            self.jsonFile.close()       # release the file for other to use
-            self.jsonFile = None        # Cause exception if called out of order
+        elif isinstance(self.jobsDict, str):  # No. Filename of shared file?
+            try:
+                if jobDict is not None:  # Yes. Changed?
+                    self.jsonFile.seek(0)  # Yes. Write back to shared file
+                    self.jsonFile.write(json_dumps(jobDict))
+                    self.jsonFile.truncate()  # Truncate any remainder of the old contents
+            finally:
+                if fcntl is not None:
+                    self.jsonFile.flush()  # write before another can read
+                    fcntl.flock(self.jsonFile.fileno(), fcntl.LOCK_UN)
+                self.jsonFile.close()   # release the file for other to use
+                self.jsonFile = None    # Cause exception if called out of order
             return
         else:                           # internal error
-            raise TypeError(f"jobDict type is {type(jobDict)} {jobDict}")
+            raise TypeError(f"self.jobDict type is {type(self.jobsDict)}: {self.jobsDict}")
@@ -17,19 +17,29 @@ and calls the neighbors() function with these parameters.
 """
 """ To Do
 Extend to process 6GHz channels too
+Cache.Reader (in cpiapi) decides whether each cached table is younger than --age.
+If cpiapi exposed the cached file's path, neighbors() could stat it once up front
+and skip logging in to CPI entirely when all three tables are fresh.
 """
 
 import csv
+import functools
+import heapq
 import math
 from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import operator
 import re
-import sys
+import threading
 from time import time
 from typing import Union
 
-from cpiapi import all_table_dicts, Cpi, Cache
+from cpiapi import Cpi, Cache
 from mylib import credentials, printIf, secsToMillis, strfTime, verbose_1
 
+from _util import prefetch, table_index
+
 
 class Chan:
     """ A WiFi channel"""
@@ -93,9 +103,23 @@ for i in range(36, 148):
 for i in range(149, 165):
     pairs[i] = int((i-5)/8)*8+5
 pairs[165] = 165
+# _chan_lut[channel] is map_chan(channel) for each channel number 0..255
+_chan_lut = list(range(256))
+for i, lower in pairs.items():
+    _chan_lut[i] = lower
 # maps each allowable band code to its default slot number
 bands = {'2.4': 0, '5.0': 1, '6.0': 2}
 
+# CPI appears to concurrently work on only 5 of the requests and queue the excess.
+# Thus, there is no speedup beyond 5 plus a couple to keep CPI's queue non-empty
+_MAX_CONCURRENT = 7
+
+_QUOTES = ('"', "'")                    # quotes that may enclose a --name_regex
+
+# rxNeighbors fields used by neighbors(), in the order that they are unpacked
+_RX_FIELDS = ('apId', 'slotId', 'macAddress_octets', 'neighborApId', 'neighborApName',
+              'neighborChannel', 'neighborRSSI', 'neighborSlotId', 'polledTime')
+
 # Maximum number of noise sources to report per radio.
 # Defines entries in the csv header row, so do not change once in production
 maxcol = 32
@@ -119,11 +143,7 @@ def map_chan(channel: int) -> int:
     :param channel:     Primary of possibly bonded ``channel``
     :return:            lower channel for ``channel``
     """
-    try:
-        channel = pairs[channel]
-    except KeyError:
-        pass
-    return channel
+    return _chan_lut[channel] if 0 <= channel < 256 else channel
 
 
 def select(source: dict, *fields) -> dict:
@@ -144,17 +164,92 @@ def select(source: dict, *fields) -> dict:
     return result
 
 
+class _Record:
+    """Base for the fixed-field records built by neighbors()"""
+    __slots__ = ()
+
+    def asdict(self) -> dict:
+        """Return a new dict of this record's fields"""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.asdict()})"
+
+
+class AccessPoint(_Record):
+    """An access point, from AccessPointDetails"""
+    __slots__ = ('id', 'locationHierarchy', 'model', 'name', 'reachabilityStatus',
+                 'macAddress_octets', 'radios', 'bldg', 'filter_ok', 'qual')
+
+    def __init__(self, rec: dict):
+        """Build an AP from an AccessPointDetails record
+
+        :param rec:         AccessPointDetails record
+        """
+        self.id = rec.get('@id')        # CPI's unique @id:int for the AP
+        self.locationHierarchy = rec.get('locationHierarchy')  # 'Case Campus > building > floor'
+        self.model = rec.get('model')   # AP model number:str
+        self.name = rec.get('name')     # AP name:str
+        self.reachabilityStatus = rec.get('reachabilityStatus')
+        self.macAddress_octets = rec['macAddress']['octets']  # base MAC:str of AP's radios
+        self.radios = dict()            # {slotId: Radio, ...}
+        nameSplit = self.name.upper().split('-')
+        self.bldg = nameSplit[0] if len(nameSplit) > 1 else 'other'  # building prefix of the AP name
+        # AP's qualifier is name without last 2 fields
+        self.qual = '-'.join(nameSplit[0:-2]) if len(nameSplit) > 2 else None
+        self.filter_ok = True           # AP name passes the name_regex filter
+
+
+class Radio(_Record):
+    """An AP's radio, from RadioDetails"""
+    __slots__ = ('channelNumber', 'mapped_chan', 'channelWidth', 'powerLevel', 'slotId', 'noise', 'neighbors')
+
+    def __init__(self, rec: dict, channelNumber: int):
+        """Build a Radio from a RadioDetails record
+
+        :param rec:         RadioDetails record
+        :param channelNumber: the radio's channel number
+        """
+        self.channelNumber = channelNumber
+        self.mapped_chan = map_chan(channelNumber)  # lower channel of a 40MHz pair
+        self.channelWidth = rec.get('channelWidth')
+        self.powerLevel = rec.get('powerLevel')
+        self.slotId = rec.get('slotId')
+        self.noise = 0.0                # co-channel interference mwatt
+        self.neighbors = list()         # [Neighbor, ...] heard by this radio
+
+
+class Neighbor(_Record):
+    """A neighbor radio heard by a radio, from rxNeighbors"""
+    __slots__ = ('ApId', 'ApName', 'Channel', 'RSSI', 'slotId')
+
+    def __init__(self, ApId: int, ApName: str, Channel: int, RSSI: int, slotId: int):
+        self.ApId = ApId
+        self.ApName = ApName
+        self.Channel = Channel
+        self.RSSI = RSSI
+        self.slotId = slotId
+
+
+_LN10_10 = math.log(10.0) / 10.0       # 10**(dbm/10) == exp(_LN10_10*dbm)
+_mw_lut = {d: math.pow(10.0, d / 10.0) for d in range(-150, 31)}  # {dbm: mwatt(dbm), ...}
+
+
 def mwatt(dbm: int) -> float:
     """Convert int dbm to mwatt."""
-    return math.pow(10.0, dbm / 10.0)
+    mw = _mw_lut.get(dbm)               # usual int dbm in -150..30?
+    return mw if mw is not None else math.exp(_LN10_10 * dbm)
+
+
+_MODEL_RE = re.compile(r'AIR-[CL]?AP(.*)-K9')  # AP model number -> model series
 
 
 def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float = 5.0,
               allchannels: bool = False, band: Union[list, None] = None,
               csv_format: bool = False, full: bool = False,
-              infile: Union[str, None] = None, maxConcurrent: int = 10,
-              name_regex: Union[str, None] = None,
-              server: str = 'ncs01.case.edu',
+              infile: Union[str, None] = None, maxConcurrent: int = _MAX_CONCURRENT,
+              name_regex: Union[str, re.Pattern, None] = None,
+              server: str = 'ncs01.case.edu', stale_age: Union[float, None] = None,
               twenty: bool = False, rxlimit: int = -90, util: float = 0.25,
               username: Union[str, None] = None, verbose: int = 0):
     """Report the co-channel noise from neighboring APs from each selected slot of each selected AP
@@ -169,8 +264,11 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
     :param full:        Include AP model suffix in model name
     :param infile:      Instead of polling, input from this filename,
     :param maxConcurrent maximum number of reader threads
-    :param name_regex:  Filter CPI for AP names that match this regex, ignoring case
+    :param name_regex:  Filter CPI for AP names that match this regex, ignoring case.
+                        A compiled regex is used as is, with its own flags
     :param server:      CPI server name
+    :param stale_age:   Report from a cached poll < `stale_age` days old, then refresh
+                        the cache in the background if it is >= `age` days old
     :param twenty:      Report specific 20 MHz channels, not 40 MHz pairs
     :param rxlimit:     Report only the neighbors with RSSI>rxlimit
     :param util:        Neighbor's assumed utilization
@@ -185,11 +283,16 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
     for b in band:                      # verify each requested  bands is known
         if b not in bands:
             raise ValueError(f"Unknown --band {b}. Specify one of {bands}")
+    band = tuple(dict.fromkeys(band))   # each band once, in the requested order
 
-    regex_string = name_regex           # remember un-compiled string
-    if name_regex is not None:
+    if isinstance(name_regex, re.Pattern):  # already compiled by the caller?
+        regex_string = name_regex.pattern  # Yes. remember un-compiled string
+    elif name_regex is not None:
+        regex_string = name_regex       # remember un-compiled string
         # compile now for error-check. re.I flag to ignore case
         name_regex = re.compile(name_regex, flags=re.I)
+    else:
+        regex_string = None
     try:
         username, password = credentials(server, username)
     except KeyError:
@@ -197,78 +300,72 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
 
     # create CPI server instance
     myCpi = Cpi(username, password, baseURL='https://' + server + '/webacs/api/')
+    if maxConcurrent is None:
+        maxConcurrent = myCpi.maxConcurrent  # use the default
 
     '''Build the following structures for calculating co-channel interference
-    APById={APD.@id:AP, ...}			index to APs by apId
-    APByMac={APD.macAddress_octets:AP, ...}	index to APs by MAC
-    AP={'apId':APD.@id					CPI's unique @id:int for the AP
-        , 'radios:{'2.4 GHz':radio, '5.0 GHz':radio, '6.0 GHz':radio}
-        , 'macAddress_octets':APD.macAddress_octets	base MAC:str of AP's radios
-        , 'locationHierarchy':APD.locationHierarchy	'Case Campus > building > floor'
-        , 'model':APD.model		        AP model number:str
-        , 'name':APD.name				AP name:str
-        }
-    radio={'channel':int(RadioDetails.channelNumber)
-        , 'channelWidth':RadioDetails.channelWidth
-        , 'powerLevel':RadioDetails.powerLevel
-        , 'neighbors':{rxNeighbors.neighborApId:rxNeighbor, ...}
-        , 'noise':0.0					co-channel interference mwatt
-    rxNeighbor={'neighborApId':rxNeighbors.neighborApId
-        , 'neighborApName':rxNeighbors.neighborApName
-        , 'neighborChannel':rxNeighbors.neighborChannel
-        , 'neighborRSSI':rxNeighbors.neighborRSSI
+    APById={APD.@id:AccessPoint, ...}	index to APs by apId
+    APByMac={APD.macAddress_octets:AccessPoint, ...}	index to APs by MAC
+    AccessPoint.radios={slotId:Radio, ...}		AP's radios from RadioDetails
+    Radio.neighbors=[Neighbor, ...]		rxNeighbors heard by the radio
     '''
     APById = dict()						# index to APs by apId
     APByMac = dict()					# index to APs by baseMacAddress
-    channels = dict()					# {buildingName:{channel:cnt, ...}, ...}
-    models = dict()						# {buildingName:{model:cnt, ...}, ...}
-
-    printIf(verbose, "Reading AccessPointDetails")
-    # Build each AP from AccessPointDetails table
-    reader = Cache.Reader(myCpi, 'v4/data/AccessPointDetails', age=age, verbose=verbose)
-    for rec in reader:
-        AP = select(rec, '@id', 'locationHierarchy', 'model', 'name', 'reachabilityStatus')
-        AP['macAddress_octets'] = macAddress_octets = rec['macAddress']['octets']
-        AP['radios'] = dict()			# radio-specific info goes here
-        if AP['@id'] in APById:			# already an AP with this @id?
-            print(f"@id in rec={rec}")
-            print(f"duplicates AP={AP}")
-            continue					# ignore duplicate
-        if macAddress_octets in APByMac:  # already an AP with this @id?
-            print(f"macAddress_octets in rec={rec}")
-            print(f"duplicates AP={AP}")
-            continue					# ignore duplicate
-        APById[AP['@id']] = AP
-        APByMac[macAddress_octets] = AP
-        nameSplit = AP['name'].upper().split('-')
-        bldg = nameSplit[0] if len(nameSplit) > 1 else 'other'
-        if name_regex is not None and not name_regex.match(bldg):
-            continue		# AP will not be reported. Don't include in model counts
-        # Count radio models by filtered AP name
-        m = re.fullmatch(r'AIR-[CL]?AP(.*)-K9', rec['model'])
-        model = m.group(1)[:(5 if full else 4)] + m.group(1)[-2:] if m else rec['model']
-        try:
+    channels = defaultdict(Counter)		# {buildingName:{channel:cnt, ...}, ...}
+    models = defaultdict(Counter)		# {buildingName:{model:cnt, ...}, ...}
+
+    # Download RadioDetails in the background while AccessPointDetails is read and processed.
+    # The worker has its own Cpi instance, so that the threads share no session or login state.
+    # The two reads split maxConcurrent, so that together they don't add to the load on CPI
+    radioCpi = Cpi(username, password, baseURL='https://' + server + '/webacs/api/')
+    radioCpi.maxConcurrent = max(1, maxConcurrent // 2)
+    myCpi.maxConcurrent = max(1, maxConcurrent - radioCpi.maxConcurrent)
+    pool = ThreadPoolExecutor(max_workers=1)
+    radio_recs = pool.submit(lambda: list(Cache.Reader(radioCpi, 'v4/data/RadioDetails',
+                                                       age=age, verbose=verbose)))
+    try:
+        printIf(verbose, "Reading AccessPointDetails")
+        # Build each AP from AccessPointDetails table
+        reader = Cache.Reader(myCpi, 'v4/data/AccessPointDetails', age=age, verbose=verbose)
+        for rec in reader:
+            AP = AccessPoint(rec)
+            macAddress_octets = AP.macAddress_octets
+            if AP.id in APById:			# already an AP with this @id?
+                print(f"@id in rec={rec}")
+                print(f"duplicates AP={AP}")
+                continue					# ignore duplicate
+            if macAddress_octets in APByMac:  # already an AP with this @id?
+                print(f"macAddress_octets in rec={rec}")
+                print(f"duplicates AP={AP}")
+                continue					# ignore duplicate
+            APById[AP.id] = AP
+            APByMac[macAddress_octets] = AP
+            bldg = AP.bldg
+            # name_regex is compiled with I flag to ignore case
+            AP.filter_ok = name_regex is None or name_regex.match(AP.name) is not None
+            if not AP.filter_ok:
+                continue		# AP will not be reported. Don't include in model counts
+            # Count radio models by filtered AP name
+            m = _MODEL_RE.fullmatch(rec['model'])
+            model = m.group(1)[:(5 if full else 4)] + m.group(1)[-2:] if m else rec['model']
             models[bldg][model] += 1
-        except KeyError:
-            try:
-                models[bldg][model] = 1
-            except KeyError:
-                models[bldg] = dict()
-                models[bldg][model] = 1
+    except BaseException:
+        radio_recs.cancel()             # abandon the download if it has not started
+        pool.shutdown(wait=False)       # report the error now, not after a running download
+        raise
+    pool.shutdown(wait=True)            # the download completes before continuing
+    myCpi.maxConcurrent = maxConcurrent  # all of maxConcurrent for reading rxNeighbors
 
     printIf(verbose, "Reading RadioDetails ")
     # Build each radio from RadioDetails table
-    reader = Cache.Reader(myCpi, 'v4/data/RadioDetails', age=age, verbose=verbose)
-    for rec in reader:
+    for rec in radio_recs.result():
         baseRadioMac = rec['baseRadioMac']['octets']
         AP = APByMac.get(baseRadioMac, None)
         if AP is None:					# Bad reference to AP?
             print(f"RadioDetails.baseRadioMac={baseRadioMac} not in APD. Radio ignored.")
             continue					# Yes, ignore this record
-        if rec['apName'] != AP['name']:  # AP name mismatch?
-            print(f"RadioDetails.apName={rec['apName']}!=APD.name={AP['name']}.")
-        # create information for this radio
-        radio = select(rec, 'channelWidth', 'powerLevel', 'slotId')
+        if rec['apName'] != AP.name:    # AP name mismatch?
+            print(f"RadioDetails.apName={rec['apName']}!=APD.name={AP.name}.")
         channelNumber = rec.get('channelNumber', None)
         if channelNumber is None:		# No channelNumber?
             print("No RadioDetails.channelNumber for {rec['apName']}.}")
@@ -277,35 +374,26 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
             try:					    # convert channelNumber:str to channelNumber:int
                 channelNumber = int(channelNumber[1:])  # skip over leading '_'
             except ValueError:
-                if not (AP['model'].startswith('C9120') and radio['slotId'] == 6 and rec['radioType'] == 'Unknown'):
-                    print(f"{rec['apName']}.{radio['slotId']} {rec['radioType']} {rec['radioRole']} "
-                          + f"is {AP['model']} w/bad RadioDetails.channelNumber={channelNumber}")
+                if not (AP.model.startswith('C9120') and rec.get('slotId') == 6 and rec['radioType'] == 'Unknown'):
+                    print(f"{rec['apName']}.{rec.get('slotId')} {rec['radioType']} {rec['radioRole']} "
+                          + f"is {AP.model} w/bad RadioDetails.channelNumber={channelNumber}")
                 continue                # ignore a radio with e.g Unknown channel number
-        slotId = radio['slotId']
-        radio['channelNumber'] = channelNumber
-        radio['noise'] = 0.0			# 0.0 mw of initial noise
-        radio['neighbors'] = list()
-        if slotId in AP['radios']:		# Already a radio for this band?
+        # create information for this radio
+        radio = Radio(rec, channelNumber)
+        slotId = radio.slotId
+        if slotId in AP.radios:		    # Already a radio for this band?
             print(f"{rec['apName']} duplicate {slotId} radio. Ignored.")
         else:
-            AP['radios'][slotId] = radio  # add the radio to the AP
+            AP.radios[slotId] = radio  # add the radio to the AP
         if channelNumber <= 11:
             continue
         # record the 5.0 GHz channel numbers used by each building
-        nameSplit = AP['name'].upper().split('-')  # building
-        bldg = nameSplit[0] if len(nameSplit) > 1 else 'other'
-        if name_regex is not None and not name_regex.match(bldg):
+        if not AP.filter_ok:
             continue		# AP will not be reported. Don't include in channel counts
+        bldg = AP.bldg                  # building
         if not twenty:
-            channelNumber = map_chan(channelNumber)
-        try:
-            channels[bldg][channelNumber] += 1
-        except KeyError:
-            try:
-                channels[bldg][channelNumber] = 1
-            except KeyError:
-                channels[bldg] = dict()
-                channels[bldg][channelNumber] = 1
+            channelNumber = radio.mapped_chan
+        channels[bldg][channelNumber] += 1
 
     if inventory is not None:
         # report the AP models and 5.0 GHz channel qty in use by each building
@@ -325,16 +413,15 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
             out.write(fhdr2.format('Building') + ' '.join(mdl) + ' chan')
             out.write(' '.join(f"{c:3}" for c in chan) + '\n')
             lst = sorted(channels.keys())
-            for bldg in lst:
-                if name_regex is None or name_regex.match(bldg):
-                    out.write(fbldg.format(bldg))
-                    m = list(models[bldg].get(model, 0) for model in mdl)
-                    out.write("    ".join(fmdl.format(qty if qty != 0 else ' ') for qty in m))
-                    out.write(f"{len(set(chan for chan in channels[bldg])):4}")
-                    for channel in chan:
-                        qty = channels[bldg].get(channel, 0)
-                        out.write(f"{qty if qty != 0 else ' ' :4}")
-                    out.write('\n')
+            for bldg in lst:            # buildings with APs that passed the name_regex filter
+                out.write(fbldg.format(bldg))
+                m = list(models[bldg].get(model, 0) for model in mdl)
+                out.write("    ".join(fmdl.format(qty if qty != 0 else ' ') for qty in m))
+                out.write(f"{len(set(chan for chan in channels[bldg])):4}")
+                for channel in chan:
+                    qty = channels[bldg].get(channel, 0)
+                    out.write(f"{qty if qty != 0 else ' ' :4}")
+                out.write('\n')
             out.write(fhdr2.format('Building') + ' '.join(mdl) + ' chan')
             out.write(' '.join(f"{c:3}" for c in chan) + '\n')
             out.write('\n"Unique chan" column is the number of unique 40 MHz channels in use\n')
@@ -343,48 +430,52 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
             out.write(f"This report generated at {strfTime(time())}\n")
 
     # find the rxNeighbors table definition, for reading or writing a csv file
-    for dictionary in all_table_dicts:  # in cpitables' dictionaries
-        tbls = dictionary.get('rxNeighbors', None)
-        if tbls is not None:
-            tbl = tbls[0]
-            break
-    else:
-        print(f"Can't find definition for rxNeighbors CPI table")
-        sys.exit(1)
+    tbls = table_index().get('rxNeighbors')  # [each table_dict that defines rxNeighbors, ...]
+    tbl = tbls[0]['rxNeighbors'][0] if tbls else None
+    if tbl is None:
+        raise RuntimeError("Can't find definition for rxNeighbors CPI table")
 
     if neighbors_filename is not None:  # supplied output file for noise & neighbor RSSI?
-        out = open(neighbors_filename, 'w')  # open report file
+        out = open(neighbors_filename, 'w', buffering=1 << 20)  # open report file
     else:
         out = None                      # no output will be produced
 
-    if maxConcurrent is not None:
-        myCpi.maxConcurrent = maxConcurrent  # override default
     printIf(verbose, "processing rxNeighbors")
     nowMsec = secsToMillis(time())
     # initialize reader to read from file, cache, or CPI
     if infile is not None:		        # input file specified?
         # Obtain rxNeighbors table from csv file
         infile = open(infile, 'r', newline='')
-        reader = csv.DictReader(infile)
+        reader = csv.reader(infile)
+        header = next(reader, [])       # column names
+        col = {name: i for i, name in enumerate(header)}
+        missing = [name for name in _RX_FIELDS if name not in col]
+        if missing:
+            infile.close()
+            raise ValueError(f"{infile.name} has no {', '.join(missing)} column(s)")
+        get_fields = operator.itemgetter(*[col[name] for name in _RX_FIELDS])
         sourceMsec = None				# polledTime is initially unknown
         printIf(verbose, f"Reading rxNeighbors data from {infile}")
     elif age and age > 0.0:             # OK to use cached data
         infile = None                   # keep IDE happy
-        reader = Cache.Reader(myCpi, tbl, age=age, verbose=verbose, name_regex=name_regex)
+        reader = prefetch(Cache.Reader(myCpi, tbl, age=max(age, stale_age or 0.0), verbose=verbose,
+                                       name_regex=name_regex), batch_size=256, depth=16)
+        get_fields = operator.itemgetter(*_RX_FIELDS)
         tbl.errorList = []              # no errors it we don't actually GET from CPI
         sourceMsec = None               # polledTime is initially unknown
         printIf(verbose, f"Reading rxNeighbors data from cache, if available")
     else:								# Obtain rxNeighbors directly from CPI
         infile = None                   # keep IDE happy
-        reader = tbl.generator(myCpi, tbl, verbose=verbose_1(verbose),
-                               name_regex=name_regex)
+        reader = prefetch(tbl.generator(myCpi, tbl, verbose=verbose_1(verbose), name_regex=name_regex),
+                          batch_size=256, depth=16)
+        get_fields = operator.itemgetter(*_RX_FIELDS)
         sourceMsec = nowMsec            # polledTime is now
         printIf(verbose, f"Reading rxNeighbors data from CPI via generator")
 
     # initialize rxWriter to write raw rxNeighbors detail to csv file
     rxWriter: Union[csv.DictWriter, None]
     if outfile is not None:		        # requested rxNeighbors output csv file?
-        outfile = open(outfile, 'w', newline='')
+        outfile = open(outfile, 'w', newline='', buffering=1 << 20)
         rxWriter = csv.DictWriter(outfile, fieldnames=tbl.select, restval='', extrasaction='ignore')
         rxWriter.writeheader()
     else:
@@ -392,6 +483,9 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
 
     # read and process al rxNeighbor records from requested source
     rec_cnt = 0             # number of records read so far, for diagnostic messages
+    # noise_lut[powerLevel][RSSI+128] is the noise mwatt of a neighbor with RSSI -128..0 at powerLevel 1..8
+    noise_lut = [[util*mwatt(rssi - 3*(powerLevel - 1)) for rssi in range(-128, 1)]
+                 for powerLevel in range(9)]
     for row in reader:
         if infile is None:		        # reading directly from CPI API?
             #                             Yes. Flatten fields to canonic csv form
@@ -400,82 +494,99 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
             row['neighborIpAddress_address'] = row['neighborIpAddress']['address']
             del row['neighborIpAddress']
             row['polledTime'] = nowMsec
+        elif not row:                   # blank line in the csv file?
+            continue                    # Yes. skip it, as DictReader does
+        apId, slotId, macAddress_octets, neighborApId, neighborApName, neighborChannel, \
+            neighborRSSI, neighborSlotId, polledTime = get_fields(row)
         if sourceMsec is None:			# sourceMsec unknown?
-            sourceMsec = int(row['polledTime'])  # remember the polledTime of the source
+            sourceMsec = int(polledTime)  # remember the polledTime of the source
         if outfile is not None:         # writing raw rxNeighbors data to csv?
-            rxWriter.writerow(row)      # Yes
+            rxWriter.writerow(row if infile is None else dict(zip(header, row)))  # Yes
         rec_cnt += 1
         if verbose > 0 and rec_cnt % 1000 == 0:
             print(f"{rec_cnt:4} records")
 
-        neighbor = dict()				# neighbor constructed here
         # Ensure that fields are correctly type-cast
-        apId = int(row['apId'])         # polled access point' Id
-        slotId = int(row['slotId'])  # polled access point's radio slotId reporting this neighbor
-        macAddress_octets = row['macAddress_octets']  # AP's base MAC
-        neighbor['ApId'] = neighborApId = int(row['neighborApId'])
-        neighbor['ApName'] = neighborApName = row['neighborApName']
-        neighbor['Channel'] = neighborChannel = int(row['neighborChannel'])
-        neighbor['RSSI'] = neighborRSSI = int(row['neighborRSSI'])
-        neighbor['slotId'] = neighborSlotId = int(row['neighborSlotId'])
+        apId = int(apId)                # polled access point' Id
+        slotId = int(slotId)            # polled access point's radio slotId reporting this neighbor
+        neighborApId = int(neighborApId)
+        neighborChannel = int(neighborChannel)
+        neighborRSSI = int(neighborRSSI)
+        neighborSlotId = int(neighborSlotId)
+        neighbor = Neighbor(neighborApId, neighborApName, neighborChannel, neighborRSSI, neighborSlotId)
         AP = APById.get(apId, None)		# get AP reported by AccessPointDetails API
         if AP is None:					# Unknown apId?
             print(f"Unknown apId={apId} hears neighbor={neighborApName} "
                   + f"on channel={neighborChannel} at {neighborRSSI}dBm.")
             continue                    # ignore record.
-        if name_regex is not None and not re.search(name_regex, AP['name']):  # AP name was not requested?
-            print(f"Unrequested {AP['name']} w/apId={apId} hears neighbor={neighborApName} "
+        if not AP.filter_ok:            # AP name was not requested?
+            print(f"Unrequested {AP.name} w/apId={apId} hears neighbor={neighborApName} "
                   + f"on channel={neighborChannel} at {neighborRSSI}dBm.")
             continue                    # ignore record.
-        if macAddress_octets != AP['macAddress_octets']: 	# bad MAC?
-            print(f"rxNeighbors {neighborApName}'s macAddress_octets={macAddress_octets}!={AP['macAddress_octets']}"
-                + f"=APByMac[{apId}].APD.macAddress_octets for {AP['name']}")
+        if macAddress_octets != AP.macAddress_octets: 	# bad MAC?
+            print(f"rxNeighbors {neighborApName}'s macAddress_octets={macAddress_octets}!={AP.macAddress_octets}"
+                + f"=APByMac[{apId}].APD.macAddress_octets for {AP.name}")
             continue					# ignore mis-correlated data
-        radio = AP['radios'].get(slotId, None)  # AP's radio for this slot
+        radio = AP.radios.get(slotId, None)  # AP's radio for this slot
         if radio is None:
-            print(f"{AP['name']} slot {slotId} is not defined in RadioDetails, but hears "
+            print(f"{AP.name} slot {slotId} is not defined in RadioDetails, but hears "
                   + f"neighbor {neighborApName} slotId {neighborSlotId} at {neighborRSSI}dBm")
             continue
         try:							# lookup neighbor radio's RadioDetails
-            neighborRadio = APById[neighborApId]['radios'][neighborSlotId]
+            neighborRadio = APById[neighborApId].radios[neighborSlotId]
         except KeyError:
-            print(f"{AP['name']} slot{slotId}  hears unknown {neighborApName} w/ApId={neighborApId} "
+            print(f"{AP.name} slot{slotId}  hears unknown {neighborApName} w/ApId={neighborApId} "
                   + f"slot{neighborSlotId} at {neighborRSSI}dBm.")
             continue
-        channelNumber = map_chan(radio['channelNumber'])
-        neighborChannel = map_chan(neighborChannel)
-        if channelNumber != neighborChannel and not allchannels:
+        if radio.mapped_chan != map_chan(neighborChannel) and not allchannels:
             continue					# Yes, ignore this rxNeighbor
-        if radio['powerLevel'] == 0 or neighborRadio['powerLevel'] == 0:  # Radio(s) off?
+        if radio.powerLevel == 0 or neighborRadio.powerLevel == 0:  # Radio(s) off?
             continue				    # Yes, ignore this rxNeighbor
         # Passed all tests.
         # Each AP transmits NDP packets on each channel at power level 1.
         # Adjust RSSI by 3dB/level * (neighborPowerLevel-1).
-        mw = util*mwatt(neighborRSSI - 3*(neighborRadio['powerLevel'] - 1))
-        radio['noise'] += mw			# add milliwatts to noise
-        radio['neighbors'].append(neighbor)
+        powerLevel = neighborRadio.powerLevel
+        if 0 < powerLevel < 9 and -128 <= neighborRSSI <= 0:  # usual powerLevel and RSSI?
+            mw = noise_lut[powerLevel][neighborRSSI + 128]  # Yes
+        else:
+            mw = util*mwatt(neighborRSSI - 3*(powerLevel - 1))
+        radio.noise += mw			    # add milliwatts to noise
+        radio.neighbors.append(neighbor)
     if verbose > 0:
         print(f"finished reading rxNeighbors")
     if infile is not None:		        # reading from infile
         infile.close()
+        no_response = []
+        unreachable_set = set()
         names = ''
         unreachable = ''
     else:								 # reading from CPI
-        unreachable = {aid for aid in APById if name_regex is None or re.search(name_regex, APById[aid]['name'])
-                       and APById[aid]['reachabilityStatus'] != 'REACHABLE'}
-        names = ', '.join(sorted((APById[aid]['name'] if aid in APById else 'Unknown')
-                                 for aid in tbl.errorList if aid not in unreachable))
-        unreachable = ', '.join(sorted(APById[aid]['name'] for aid in unreachable))
+        unreachable_set = {aid for aid in APById
+                           if APById[aid].filter_ok
+                           and APById[aid].reachabilityStatus != 'REACHABLE'}
+        no_response = [aid for aid in tbl.errorList if aid not in unreachable_set]
+        names = ', '.join(sorted((APById[aid].name if aid in APById else 'Unknown')
+                                 for aid in no_response))
+        unreachable = ', '.join(sorted(APById[aid].name for aid in unreachable_set))
         if len(unreachable) > 0:
             print(f"APs with reachabilityStatus!='REACHABLE': {unreachable}")
         if len(names) > 0:
             print(f"APs {names} didn't return neighbor status")
     if outfile is not None:
         outfile.close()
+    if infile is None and stale_age is not None and stale_age > age > 0.0:  # accepted a stale poll?
+        def refresh():                  # Yes. Poll again iff the cache is older than age
+            for _ in Cache.Reader(myCpi, tbl, age=age, verbose=verbose_1(verbose), name_regex=name_regex):
+                pass
+
+        printIf(verbose, f"Refreshing the cached rxNeighbors poll in the background")
+        # not a daemon, so the refresh completes after the reports are written
+        threading.Thread(name='refresh', target=refresh).start()
 
     printIf(verbose, "reporting results")
     # Report the results, sorted by apName
-    lst = sorted((APById[apId]['name'].upper(), apId) for apId in APById)
+    rssi_key = operator.attrgetter('RSSI')  # sort key for the neighbors of a radio
+    lst = sorted((APById[apId].name.upper(), apId) for apId in APById)
     # use narrower field widths when generating textual report for allchannels
     f_hdr = '{:18}{:>9}' + 8*('   neighbor '[(-10 if allchannels else -11):] + 'RSSI') + '\n'
     f_neighbor = '{:>' + str(10 if allchannels else 11) + '}{:4}'
@@ -487,56 +598,57 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
                       + f"{','.join(['neighbor'+str(i)+',RSSI'+str(i) for i in range(1,maxcol+1)])}\n")
         else:
             out.write(f_hdr.format(' AP name[.slot]', 'noise dbm'))
-    for aband in band:
-        for sortKey, apId in lst:
-            AP = APById[apId]
-            name = AP['name']			# get the possibly mixed-case name
-            # name_regex is compiled with I flag to ignore case
-            if name_regex is not None and not name_regex.match(name):
-                continue				# ignore AP if name doesn't match the filter
-            nameSplit = name.split('-')
-            # AP's qualifier is name without last 2 fields
-            qual = '-'.join(nameSplit[0:-2]).upper() if len(nameSplit) > 2 else None
-            for slotId in AP['radios']:  # for each radio
-                radio = AP['radios'][slotId]  # the radio
-                theBand = '2.4' if radio['channelNumber'] <= 11 \
-                    else '5.0' if radio['channelNumber'] <= 165 else '6.0'
-                if aband != theBand:    # not the band that is being processed?
-                    continue			# ignore this radio now
-                if out is not None:
-                    if csv_format:		# csv output?
-                        out.write(f"{name}.{slotId},{dBm(radio['noise'])}")
-                    else:				# No. text columns output
-                        name_slot = name
-                        if slotId != bands[theBand]:  # Unusual slotId for this band?
-                            name_slot += f".{slotId}"  # append unusual slotId to name_slot
-                        out.write(f"{name_slot:23}{dBm(radio['noise']):4}")
-                neighbors = radio['neighbors']
-                # sort neighbors by descending RSSI
-                n = sorted((-neighbors[i]['RSSI'], i) for i in range(len(neighbors)))
-                n = n[:maxcol]      # limit the number of noise sources reported
-                for negRSSI, i in n:
-                    if -negRSSI < rxlimit:  # RSSI less than limit?
-                        break			# yes, ignore all remaining in sorted list
-                    neighbor = neighbors[i]
-                    ApName = neighbor['ApName']
-                    nslotId = neighbor['slotId']
-                    nSplit = ApName.split('-')
-                    if out is not None:
-                        if csv_format:  # csv output?
-                            out.write(f",{ApName}.{nslotId},{-negRSSI}")
-                        else:			# text columns output
-                            if nslotId != bands[theBand]:  # unusual slotId?
-                                ApName += f".{slotId}"  # Yes. Append unusual slotId to ApName
-                            # neighbor has same location?
-                            if '-'.join(nSplit[0:-2]).upper() == qual:
-                                ApName = '-'.join(nSplit[-2:])[(-9 if allchannels else -10):]
-                                out.write(f_neighbor.format(ApName, -negRSSI))  # only SER-WAP
-                            else:		# No. Different qualifier -> use last 10+ chars w/o spacing
-                                ApName = ApName[(-10 if allchannels else -11):]
-                                out.write(f_foreign.format(ApName, -negRSSI))
-                if out is not None:
-                    out.write('\n')     # complete the record with a newline
+    # bucket each reported radio by band, in AP name order
+    name_parts = dict()                 # {ApName: (qualifier, last 2 fields), ...}
+    per_band = {b: [] for b in band}    # {requested band: [(AP, slotId, radio), ...], ...}
+    for sortKey, apId in lst:
+        AP = APById[apId]
+        if not AP.filter_ok:
+            continue				    # ignore AP if name doesn't match the filter
+        for slotId, radio in AP.radios.items():  # for each radio
+            theBand = '2.4' if radio.channelNumber <= 11 \
+                else '5.0' if radio.channelNumber <= 165 else '6.0'
+            radios = per_band.get(theBand)
+            if radios is not None:      # band was requested?
+                radios.append((AP, slotId, radio))
+    for theBand in band:
+        if out is None:                 # no report requested?
+            break                       # Yes. Nothing to format
+        for AP, slotId, radio in per_band[theBand]:
+            name = AP.name			    # get the possibly mixed-case name
+            qual = AP.qual
+            if csv_format:		        # csv output?
+                parts = [f"{name}.{slotId},{dBm(radio.noise)}"]
+            else:				        # No. text columns output
+                name_slot = name
+                if slotId != bands[theBand]:  # Unusual slotId for this band?
+                    name_slot += f".{slotId}"  # append unusual slotId to name_slot
+                parts = [f"{name_slot:23}{dBm(radio.noise):4}"]
+            # the maxcol neighbors with the highest RSSI>=rxlimit, by descending RSSI
+            top = heapq.nlargest(maxcol, (nb for nb in radio.neighbors if nb.RSSI >= rxlimit),
+                                 key=rssi_key)
+            for neighbor in top:
+                RSSI = neighbor.RSSI
+                ApName = neighbor.ApName
+                nslotId = neighbor.slotId
+                if csv_format:          # csv output?
+                    parts.append(f",{ApName}.{nslotId},{RSSI}")
+                else:			        # text columns output
+                    nParts = name_parts.get(ApName)
+                    if nParts is None:  # 1st appearance of this neighbor name?
+                        nSplit = ApName.split('-')
+                        nParts = name_parts[ApName] = ('-'.join(nSplit[0:-2]).upper(), '-'.join(nSplit[-2:]))
+                    if nslotId != bands[theBand]:  # unusual slotId?
+                        ApName += f".{slotId}"  # Yes. Append unusual slotId to ApName
+                    # neighbor has same location?
+                    if nParts[0] == qual:
+                        ApName = nParts[1][(-9 if allchannels else -10):]
+                        parts.append(f_neighbor.format(ApName, RSSI))  # only SER-WAP
+                    else:		        # No. Different qualifier -> use last 10+ chars w/o spacing
+                        ApName = ApName[(-10 if allchannels else -11):]
+                        parts.append(f_foreign.format(ApName, RSSI))
+            parts.append('\n')          # complete the record with a newline
+            out.write(''.join(parts))   # one write per radio
     if out is not None:
         if csv_format:
             # output each summary as an AP named $MetaData$-xxx
@@ -544,8 +656,8 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
             out.write(f"MetaData$regexFilter,{regex_string}\n")
             out.write(f"$MetaData$rxLimit,{rxlimit}\n")
             out.write(f"$MetaData$allChannels, {allchannels}\n")
-            out.write(f"$MeteData$unreachableCount,{len(unreachable)}\n")
-            out.write(f"$MetaData$noResponseCount,{len(unreachable)}\n")
+            out.write(f"$MeteData$unreachableCount,{len(unreachable_set)}\n")
+            out.write(f"$MetaData$noResponseCount,{len(no_response)}\n")
         else:
             # output textual meta data
             out.write('\nA radio name has a ".slot#" suffix iff its slot is '
@@ -565,17 +677,21 @@ def neighbors(inventory: str, neighbors_filename: str, outfile: str, age: float
                 out.write(f" with AP name that matches {regex_string}.\n")
             out.write(f"Reporting rxNeighbors with RSSI greater than {rxlimit} dBm\n")
             if len(unreachable) > 0:
-                out.write(f"{len(unreachable)} Unreachable APs: {unreachable}\n")
+                out.write(f"{len(unreachable_set)} Unreachable APs: {unreachable}\n")
             if len(names) > 0:
-                out.write(f"{len(names)} APs didn't respond to a RxNeighbor status request: {names}\n")
+                out.write(f"{len(no_response)} APs didn't respond to a RxNeighbor status request: {names}\n")
             out.write(f"This report generated at {strfTime(time())}\n")
             if infile is not None:
                 out.write(f", from data polled at {strfTime(sourceMsec)}\n")
         out.close()
 
 
-if __name__ == '__main__':
-    # Parse command line for options
+@functools.lru_cache(maxsize=None)
+def _build_parser() -> ArgumentParser:
+    """Build the command line parser. Built once, on the first call.
+
+    :return:            the ArgumentParser for the neighbors.py command line
+    """
     parser = ArgumentParser(description='For each AP slot, report the co-channel noise from neighboring APs')
     parser.add_argument('inventory', action='store',
                         help="report filename for AP model qty and channel qty by building")
@@ -597,14 +713,15 @@ if __name__ == '__main__':
                         help="Include AP model suffix in model name")
     parser.add_argument('--infile', action='store', default=None,
                         help="input rxNeighbors.csv filename, instead of polling")
-    # CPI appears to concurrently work on only 5 of the requests and queue the excess.
-    # Thus, there is no speedup beyond 5 plus a couple to keep queue CPI's non-empty
-    parser.add_argument('--maxConcurrent', action='store', type=int, default=10,
-                        help="maximum number of reader threads.")
+    parser.add_argument('--maxConcurrent', action='store', type=int, default=_MAX_CONCURRENT,
+                        help=f"maximum number of reader threads. (max={_MAX_CONCURRENT})")
     parser.add_argument('--name_regex', action='store', default=None,
                         help="filter AP names that match this regex, ignoring case.")
     parser.add_argument('--server', action='store', default="ncs01.case.edu",
                         help='CPI server name. default=ncs01.case.edu')
+    parser.add_argument('--stale_age', action='store', type=float, default=None,
+                        help='Report from a cached rxNeighbors poll < stale_age days old, '
+                        + 'then refresh the cache in the background if it is > age days old')
     parser.add_argument('--twenty', action='store_true', default=False,
                         help="Report specific 20 MHz channels, not 40 MHz pairs")
     parser.add_argument('--username', action='store', default=None,
@@ -615,14 +732,31 @@ if __name__ == '__main__':
                         default=25, help="neighbor's assumed utilization (default=25)")
     parser.add_argument('--verbose', action='count', default=0,
                         help="increase diagnostic messages")
+    return parser
+
+
+if __name__ == '__main__':
+    # Parse command line for options
+    parser = _build_parser()
     args = parser.parse_args()
 
     if args.name_regex is not None:
         # Remove enclosing quotes, if any
-        if args.name_regex[0] == args.name_regex[-1] and args.name_regex[0] in {'"', "'"}:
-            print(f"Removing enclosing quotes from name_regex: {args.name_regex}-->{args.name_regex[1:-1]}")
+        if len(args.name_regex) > 1 and args.name_regex[0] == args.name_regex[-1] \
+                and args.name_regex[0] in _QUOTES:
+            printIf(args.verbose, f"Removing enclosing quotes from name_regex: "
+                    + f"{args.name_regex}-->{args.name_regex[1:-1]}")
             args.name_regex = args.name_regex[1:-1]
         printIf(args.verbose, f"Report includes only AP names matching {args.name_regex}")
+        try:                            # compile once, ignoring case
+            args.name_regex = re.compile(args.name_regex, flags=re.I)
+        except re.error as e:
+            parser.error(f"--name_regex {args.name_regex}: {e}")
+
+    if not 0 < args.maxConcurrent <= _MAX_CONCURRENT:  # outside the useful range?
+        limited = min(max(args.maxConcurrent, 1), _MAX_CONCURRENT)
+        print(f"Limiting maxConcurrent {args.maxConcurrent} to {limited}")
+        args.maxConcurrent = limited
 
     if args.rxlimit > 0:                # user specified a positive RSSI?
         print(f"Correcting rxlimit {args.rxlimit} to a negative number {-args.rxlimit}")
@@ -630,11 +764,8 @@ if __name__ == '__main__':
 
     args.util = (args.util/100.0)	    # convert integer percent to float factor
 
-    inv = args.inventory
-    nei = args.neighbors
-    outfile_name = args.outfile
-    args = vars(args)                   # convert Namespace to dict
-    del args['inventory']
-    del args['neighbors']
-    del args['outfile']
-    neighbors(inv, nei, outfile_name, **args)
+    neighbors(args.inventory, args.neighbors, args.outfile, age=args.age,
+              allchannels=args.allchannels, band=args.band, csv_format=args.csv_format,
+              full=args.full, infile=args.infile, maxConcurrent=args.maxConcurrent,
+              name_regex=args.name_regex, server=args.server, stale_age=args.stale_age, twenty=args.twenty,
+              rxlimit=args.rxlimit, util=args.util, username=args.username, verbose=args.verbose)
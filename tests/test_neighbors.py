@@ -0,0 +1,65 @@
+import csv
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('cpiapi')
+pytest.importorskip('mylib')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'collect'))
+import neighbors as nb  # noqa: E402
+
+_APS = [{'@id': 1000 + i, 'locationHierarchy': 'Campus > BLDA > Floor 1', 'model': 'AIR-AP3802I-B-K9',
+         'name': f"BLDA-F1-WAP{i:02d}", 'reachabilityStatus': 'REACHABLE',
+         'macAddress': {'octets': f"00:00:00:00:00:{i:02x}"}} for i in range(2)]
+_RADIOS = [{'baseRadioMac': {'octets': ap['macAddress']['octets']}, 'apName': ap['name'],
+            'channelWidth': 20, 'powerLevel': 1, 'slotId': 1, 'channelNumber': '_36',
+            'radioType': '802.11a', 'radioRole': 'Client Serving'} for ap in _APS]
+
+
+class _Cache:
+    """Stands in for cpiapi.Cache. Reader yields the canned AccessPointDetails or RadioDetails"""
+    class Reader:
+        def __init__(self, cpi, table, **kwargs):
+            self.table = table
+
+        def __iter__(self):
+            return iter({'v4/data/AccessPointDetails': _APS, 'v4/data/RadioDetails': _RADIOS}[self.table])
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    """neighbors() without logging in to, or polling, CPI"""
+    monkeypatch.setattr(nb, 'credentials', lambda server, username: ('user', 'password'))
+    monkeypatch.setattr(nb, 'Cpi', lambda *args, **kwargs: types.SimpleNamespace(maxConcurrent=5))
+    monkeypatch.setattr(nb, 'Cache', _Cache)
+
+
+def write_rx(file_name: str, blank_lines: bool):
+    """Write an rxNeighbors csv in which each AP hears the other, optionally with blank lines"""
+    fields = nb._RX_FIELDS + ('neighborIpAddress_address',)
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for ap, other in ((_APS[0], _APS[1]), (_APS[1], _APS[0])):
+            values = {'apId': ap['@id'], 'slotId': 1, 'macAddress_octets': ap['macAddress']['octets'],
+                      'neighborApId': other['@id'], 'neighborApName': other['name'],
+                      'neighborChannel': 36, 'neighborRSSI': -60, 'neighborSlotId': 1,
+                      'polledTime': 1600000000000, 'neighborIpAddress_address': '10.0.0.1'}
+            writer.writerow([values[name] for name in fields])
+            if blank_lines:
+                f.write('\r\n')
+
+
+def test_infile_blank_lines(offline, tmp_path):
+    """Blank lines in the --infile csv are skipped, so the reports are as without them"""
+    reports = []
+    for blank_lines in (False, True):
+        rx = str(tmp_path / f"rx{blank_lines}.csv")
+        write_rx(rx, blank_lines)
+        nb_file = tmp_path / f"nb{blank_lines}.txt"
+        nb.neighbors(str(tmp_path / f"inv{blank_lines}.txt"), str(nb_file), None, 0.0, infile=rx)
+        reports.append(nb_file.read_text().splitlines()[:-1])  # without the generated-at line
+    assert reports[0] == reports[1]
+    assert any('BLDA-F1-WAP01' in line for line in reports[1])